@@ -1,15 +1,32 @@
+import os
+import queue
+import re
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
 import typer
 import sys
 from pathlib import Path
-from scrapy.crawler import CrawlerProcess
-from scrapy.settings import Settings
-from scrapy.signalmanager import dispatcher
-from scrapy import signals
+from typing import TYPE_CHECKING, List, Optional
 
-# Import project components
-from examtopics_scraper.spiders import ExamtopicsExamsSpider, ExamtopicsQuestionsSpider
-from examtopics_scraper.exporters import ItemCollectorPipeline # Import the collector
-from examtopics_scraper.processing import process_question_data
+# Import project components. Scrapy, Twisted, requests and lxml (spiders,
+# exporters, index, processing, refresh) are imported by the commands that
+# use them, so --help, completion and quick commands start fast.
+from examtopics_scraper.bench import app as bench_app
+from examtopics_scraper.cache import DEFAULT_LISTING_TTL, DEFAULT_MAX_SIZE, DEFAULT_QUESTION_TTL, ResponseCache, cache_from_settings
+from examtopics_scraper.checkpoint import ScrapeJournal
+from examtopics_scraper.defaults import (BASE_URL, DEFAULT_CONCURRENCY, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS,
+                                         DEFAULT_MAX_JOBS, DEFAULT_SHARD_SIZE, REQUEST_TIMEOUT)
+from examtopics_scraper.stats import RunStats, profiled
+from examtopics_scraper.throttle import DEFAULT_MAX_RETRIES
+from examtopics_scraper.watermark import HighWaterMark
+from examtopics_scraper.writers import OutputFormat, output_format_for
+
+if TYPE_CHECKING:
+    from scrapy.settings import Settings
+    from examtopics_scraper.refresh import DatasetRefresh
 
 # --- Typer App Initialization ---
 app = typer.Typer(
@@ -17,40 +34,215 @@ app = typer.Typer(
     help="A CLI tool to scrape ExamTopics exam lists and question discussion URLs, then process question details.",
     add_completion=False,
 )
+app.add_typer(bench_app)
+
+# Site root used by every command, set by the --base-url global option
+site = {'base_url': BASE_URL}
+
+
+@app.callback()
+def main(
+    base_url: str = typer.Option(
+        BASE_URL, "--base-url", envvar="EXAMTOPICS_BASE_URL",
+        help="Root URL of the site to scrape, e.g. a local stand-in server for benchmarks.",
+    ),
+):
+    site['base_url'] = base_url
+
+
+def new_settings() -> 'Settings':
+    """Scrapy settings shared by every command."""
+    from scrapy.settings import Settings
+
+    settings = Settings()
+    settings['EXAMTOPICS_BASE_URL'] = site['base_url']
+    return settings
+
+
+class DetailEngine(str, Enum):
+    """How question detail pages are fetched by the `scrape` command."""
+    requests = "requests" # Thread pool over pooled requests sessions, fed by the spider
+    scrapy = "scrapy" # Scrapy callbacks in the same reactor as the listing crawl
+
+
+def configure_cache(settings: 'Settings', cache_path: Optional[Path], listing_ttl_hours: float = DEFAULT_LISTING_TTL / 3600,
+                    question_ttl_hours: float = DEFAULT_QUESTION_TTL / 3600,
+                    max_size_mb: int = DEFAULT_MAX_SIZE // 2**20, offline: bool = False):
+    """
+    Enables the response cache in Scrapy `settings`. The detail stage opens the
+    same cache with `cache_from_settings`.
+    """
+    if cache_path is None:
+        if offline:
+            print("--offline requires --cache.", file=sys.stderr)
+            raise typer.Exit(code=1)
+        return
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Closer to the engine than HttpCompressionMiddleware (590): decoded bodies are cached
+    settings['DOWNLOADER_MIDDLEWARES'] = {'examtopics_scraper.middlewares.ResponseCacheMiddleware': 580}
+    settings['RESPONSE_CACHE_PATH'] = str(cache_path)
+    settings['RESPONSE_CACHE_LISTING_TTL'] = listing_ttl_hours * 3600
+    settings['RESPONSE_CACHE_QUESTION_TTL'] = question_ttl_hours * 3600
+    settings['RESPONSE_CACHE_MAX_SIZE'] = max_size_mb * 2**20
+    settings['RESPONSE_CACHE_OFFLINE'] = offline
+
+
+def start_detail_worker(item_queue: queue.Queue, output_csv: Path, detail_options: dict,
+                        cache: Optional[ResponseCache] = None, append: bool = False):
+    """
+    Starts the detail stage in a background thread, consuming question items
+    from `item_queue` while the spider is still crawling the listing.
+    `detail_options` are passed on to process_question_data.
+
+    Returns the thread and a dict that receives the number of consumed items
+    and any exception raised by the detail stage.
+    """
+    from examtopics_scraper.exporters import run_detail_stage
+
+    outcome = {'items': 0, 'error': None}
+
+    def run():
+        try:
+            outcome['items'] = run_detail_stage(item_queue, str(output_csv), detail_options, cache, append)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, name="question-details", daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+def load_indexed_questions(index_path: Path, provider: str, exam_code: str):
+    """Resolves the questions of an exam from a complete provider index, or exits."""
+    from examtopics_scraper.index import DiscussionIndex
+
+    index = DiscussionIndex(str(index_path))
+    try:
+        completed_at = index.completed_at(provider)
+        if completed_at is None:
+            print(f"No complete index for provider '{provider}' in {index_path}. "
+                  f"Run 'build-index {provider} --index {index_path}' first.", file=sys.stderr)
+            raise typer.Exit(code=1)
+        questions = index.resolve(provider, exam_code)
+    finally:
+        index.close()
+    print(f"Resolved {len(questions)} questions of {exam_code} from the index "
+          f"(built {time.strftime('%Y-%m-%d %H:%M', time.localtime(completed_at))}).")
+    return questions
+
+
+def crawl_discussion_index(provider: str, index_path: Path, settings: 'Settings'):
+    """Crawls the whole discussion listing of `provider` into the index at `index_path`. Returns the crawler."""
+    from scrapy.crawler import CrawlerProcess
+    from examtopics_scraper.spiders import ExamtopicsDiscussionsSpider
+
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    settings['ITEM_PIPELINES'] = {
+        'examtopics_scraper.exporters.DiscussionIndexPipeline': 1
+    }
+    settings['DISCUSSION_INDEX_PATH'] = str(index_path)
+    settings['LOG_LEVEL'] = 'INFO'
+    settings['ROBOTSTXT_OBEY'] = False
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(ExamtopicsDiscussionsSpider)
+    process.crawl(crawler, provider=provider)
+    try:
+        process.start()
+    except Exception as e:
+        print(f"An error occurred during the index crawl: {e}", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if crawler.stats.get_value('finish_reason') != 'finished':
+        print(f"The index crawl did not finish ({crawler.stats.get_value('finish_reason')}). "
+              f"The previous index of {provider}, if any, was kept.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if failed := crawler.stats.get_value('examtopics/listing_pages_failed'):
+        print(f"{failed} listing pages could not be fetched. "
+              f"The previous index of {provider}, if any, was kept.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    print(f"Indexed {crawler.stats.get_value('item_scraped_count', 0)} discussions of {provider} in {index_path}.")
+    return crawler
+
+
+@contextmanager
+def run_report(stats_path: Optional[Path], profile_path: Optional[Path]):
+    """
+    Yields the RunStats of a command. They are written to `stats_path` when
+    the command exits, even on failure, and the command is profiled into
+    `profile_path` if given.
+    """
+    run_stats = RunStats()
+    start = time.perf_counter()
+    try:
+        with profiled(str(profile_path) if profile_path else None):
+            yield run_stats
+    finally:
+        run_stats.add_time('run', time.perf_counter() - start)
+        if stats_path:
+            stats_path.parent.mkdir(parents=True, exist_ok=True)
+            run_stats.write(str(stats_path))
+            print(f"Run stats written to {stats_path}")
+
+
+def open_journal(output_csv: Path, resume: bool) -> ScrapeJournal:
+    """Opens the journal of completed questions kept next to `output_csv` (<output>.journal)."""
+    return ScrapeJournal(str(output_csv.with_name(output_csv.name + ".journal")), resume=resume)
+
+
+def start_refresh(output_csv: Path, output_format: Optional[str]):
+    """
+    Loads the previous output and its <output>.meta.json for a refresh.
+    Returns the DatasetRefresh and the work file the patched dataset is
+    written to, which replaces the output once the refresh is complete.
+    """
+    from examtopics_scraper.refresh import DatasetRefresh
 
-# --- Global variable to hold collected items ---
-# This is a simple way to pass data from the pipeline back to the main script
-# when using CrawlerProcess and signals.
-collected_items_global = []
+    output_format = output_format_for(str(output_csv), output_format)
+    refresh = DatasetRefresh(str(output_csv), str(output_csv.with_name(output_csv.name + ".meta.json")),
+                             output_format)
+    print(f"Refreshing {len(refresh.previous_rows)} known questions of {output_csv}.")
+    return refresh, output_csv.with_name(output_csv.name + ".refresh.tmp")
 
-def spider_closed_handler(spider, reason):
-    """Signal handler to access collected items after spider closes."""
-    global collected_items_global
-    # Access the pipeline instance through the crawler's pipeline manager
-    # Note: This relies on internal Scrapy structure but is a common pattern.
-    # Ensure ItemCollectorPipeline is uniquely identifiable if multiple pipelines exist.
-    for p in spider.crawler.engine.scraper.itemproc.middlewares: # CORRECTED LINE based on debug output
-        if isinstance(p, ItemCollectorPipeline):
-            collected_items_global = p.items
-            break
-    spider.logger.info(f"Spider closed: {reason}. Items collected: {len(collected_items_global)}")
+
+def finish_refresh(refresh: 'DatasetRefresh', output_csv: Path, work_path: Path, changes_path: Optional[Path],
+                   complete: bool):
+    """Swaps in the patched dataset and writes the change set, or discards an incomplete refresh."""
+    if not complete:
+        work_path.unlink(missing_ok=True)
+        print(f"Refresh incomplete, {output_csv} left unchanged.", file=sys.stderr)
+        return
+    changes_path = changes_path or output_csv.with_name(output_csv.name + ".changes.jsonl")
+    refresh.finish(str(changes_path))
+    os.replace(work_path, output_csv)
+    print(f"Refresh: {refresh.summary()}. Change set written to {changes_path}")
 
 
 @app.command("list-exams")
 def list_exams(
-    provider: str = typer.Argument(..., help="The exam provider code (e.g., 'microsoft', 'amazon').")
+    provider: str = typer.Argument(..., help="The exam provider code (e.g., 'microsoft', 'amazon')."),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
 ):
     """
     Lists all available exams for a given provider by scraping ExamTopics.
     """
+    from scrapy.crawler import CrawlerProcess
+    from examtopics_scraper.spiders import ExamtopicsExamsSpider
+
     print(f"Fetching exams for provider: {provider}...")
 
-    settings = Settings()
+    settings = new_settings()
     settings['ITEM_PIPELINES'] = {
         'examtopics_scraper.exporters.ExamtopicsExamsStdoutPipeline': 1
     }
     settings['LOG_LEVEL'] = 'INFO'
     settings['ROBOTSTXT_OBEY'] = False # Be respectful, but ExamTopics often blocks default Scrapy UA
+    configure_cache(settings, cache_path, offline=offline)
 
     process = CrawlerProcess(settings)
     process.crawl(ExamtopicsExamsSpider, provider=provider)
@@ -70,17 +262,116 @@ def scrape_and_process(
     output_csv: Path = typer.Option(
         ..., # Make output mandatory
         "--output", "-o",
-        help="Path to the output CSV file where processed question data will be saved.",
+        help="Path to the output file where processed question data will be saved: CSV, or JSON Lines (.jsonl) "
+             "or Parquet (.parquet) by extension or --format.",
         writable=True,
         resolve_path=True, # Ensure path is absolute
     ),
+    concurrency: int = typer.Option(
+        DEFAULT_CONCURRENCY,
+        "--concurrency", "-c",
+        min=1,
+        help="Maximum number of question pages fetched at the same time. Higher is faster but more likely to get blocked.",
+    ),
+    output_format: Optional[OutputFormat] = typer.Option(
+        None, "--format",
+        help="Output file format. Defaults to the format of the output file extension, CSV otherwise. "
+             "Parquet requires pyarrow (pip install examtopics_scraper[parquet]).",
+    ),
+    max_retries: int = typer.Option(
+        DEFAULT_MAX_RETRIES, "--max-retries", min=0,
+        help="Retries of a question page on timeouts, 429 and 5xx responses before it is left empty.",
+    ),
+    engine: DetailEngine = typer.Option(
+        DetailEngine.requests,
+        "--engine",
+        help="Fetch question pages with a requests thread pool, or as Scrapy callbacks in the crawl itself "
+             "(Scrapy scheduler, retries and AutoThrottle).",
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs, shared by the listing crawl and the detail stage.",
+        resolve_path=True,
+    ),
+    listing_ttl: float = typer.Option(
+        DEFAULT_LISTING_TTL / 3600, "--listing-ttl", min=0,
+        help="Hours a cached discussion listing page stays fresh.",
+    ),
+    question_ttl: float = typer.Option(
+        DEFAULT_QUESTION_TTL / 3600, "--question-ttl", min=0,
+        help="Hours a cached question page stays fresh.",
+    ),
+    cache_max_mb: int = typer.Option(
+        DEFAULT_MAX_SIZE // 2**20, "--cache-max-mb", min=1,
+        help="Maximum compressed cache size; least recently used pages are evicted beyond it.",
+    ),
+    offline: bool = typer.Option(
+        False, "--offline",
+        help="Serve pages only from the cache, never from the network (e.g. to re-run extraction).",
+    ),
+    index_path: Optional[Path] = typer.Option(
+        None, "--index",
+        help="Resolve the question URLs from a provider index built by 'build-index' instead of crawling the listing.",
+        resolve_path=True,
+    ),
+    incremental: bool = typer.Option(
+        False, "--incremental",
+        help="Only crawl the listing pages newer than the last run and append the new questions to the output.",
+    ),
+    state_path: Optional[Path] = typer.Option(
+        None, "--state",
+        help="JSON file remembering the newest discussions of the last run. Defaults to <output>.watermark.json.",
+        resolve_path=True,
+    ),
+    parse_workers: int = typer.Option(
+        0, "--parse-workers", min=0,
+        help="Parse question pages in this many processes (requests engine), e.g. when replaying a large cache "
+             "with --offline. 0 parses in the fetch threads.",
+    ),
+    resume: bool = typer.Option(
+        False, "--resume",
+        help="Continue an interrupted or partly failed scrape from its journal (<output>.journal): completed "
+             "questions are reused, only the failed or missing ones are fetched (requests engine).",
+    ),
+    refresh_output: bool = typer.Option(
+        False, "--refresh",
+        help="Refresh an existing output: request question pages conditionally (ETag/Last-Modified from "
+             "<output>.meta.json), patch the output and write only the added, changed and removed questions "
+             "to the change set (requests engine).",
+    ),
+    changes_path: Optional[Path] = typer.Option(
+        None, "--changes",
+        help="Change set (JSON Lines) of a --refresh. Defaults to <output>.changes.jsonl.",
+        resolve_path=True,
+    ),
+    stats_path: Optional[Path] = typer.Option(
+        None, "--stats",
+        help="Write the counters and timings of the run (merged with Scrapy's stats) to this file at exit: "
+             "a Prometheus textfile if it ends with .prom, JSON otherwise.",
+        resolve_path=True,
+    ),
+    profile_path: Optional[Path] = typer.Option(
+        None, "--profile",
+        help="Profile the run with cProfile, including the fetch threads, and write the pstats dump here.",
+        resolve_path=True,
+    ),
 ):
     """
     Scrapes question URLs for a specific exam, fetches details for each question,
     processes the data, and saves it to a CSV file.
+
+    Question URLs are streamed to the detail stage as soon as the spider finds
+    them, so crawling the listing and fetching question pages overlap.
     """
-    global collected_items_global
-    collected_items_global = [] # Reset global list before crawl
+    if incremental and output_format_for(str(output_csv), output_format) == OutputFormat.parquet:
+        print("--incremental appends to the output, which Parquet files do not support.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if (resume or refresh_output) and engine == DetailEngine.scrapy:
+        print("--resume and --refresh require --engine requests.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if refresh_output and (resume or incremental):
+        print("--refresh cannot be combined with --resume or --incremental.", file=sys.stderr)
+        raise typer.Exit(code=1)
 
     print(f"Starting scrape for {provider}/{exam_code}...")
     print(f"Output will be saved to: {output_csv}")
@@ -88,46 +379,592 @@ def scrape_and_process(
     # Ensure output directory exists
     output_csv.parent.mkdir(parents=True, exist_ok=True)
 
-    settings = Settings()
-    # Configure Scrapy to use the ItemCollectorPipeline
+    settings = new_settings()
+    configure_cache(settings, cache_path, listing_ttl, question_ttl, cache_max_mb, offline)
+    questions = load_indexed_questions(index_path, provider, exam_code) if index_path else None
+
+    watermark = None
+    known_urls = None
+    if incremental:
+        if index_path:
+            print("--incremental cannot be combined with --index.", file=sys.stderr)
+            raise typer.Exit(code=1)
+        state_path = state_path or output_csv.with_name(output_csv.name + ".watermark.json")
+        watermark = HighWaterMark(str(state_path))
+        known = watermark.known_urls(provider, exam_code)
+        if known and output_csv.exists() and output_csv.stat().st_size > 0:
+            known_urls = known
+            print(f"Incremental scrape: {len(known_urls)} known discussions, new questions are appended.")
+        else:
+            print("Incremental scrape: no previous run recorded, crawling the whole listing.")
+
+    # The requests engine journals completed questions, so any interrupted run can be resumed.
+    # A refresh writes the patched dataset next to the output instead, and swaps it in at the end.
+    output_path, journal, refresh = output_csv, None, None
+    if refresh_output:
+        refresh, output_path = start_refresh(output_csv, output_format)
+        output_format = output_format_for(str(output_csv), output_format)
+    elif engine == DetailEngine.requests:
+        journal = open_journal(output_csv, resume)
+    detail_options = {'concurrency': concurrency, 'parse_workers': parse_workers, 'journal': journal,
+                      'max_retries': max_retries, 'output_format': output_format, 'refresh': refresh}
+    complete = False
+    crawler = None
+    failed_pages = 0
+    with run_report(stats_path, profile_path) as run_stats:
+        detail_options['stats'] = run_stats
+        try:
+            if engine == DetailEngine.requests and questions is not None:
+                process_indexed_questions(questions, output_path, detail_options, settings)
+                complete = True
+                return
+
+            if engine == DetailEngine.scrapy:
+                crawler, item_count = scrape_in_reactor(provider, exam_code, output_path, concurrency, settings,
+                                                        questions=questions, known_urls=known_urls,
+                                                        fan_out=not incremental, max_retries=max_retries,
+                                                        output_format=output_format)
+            else:
+                crawler, item_count = scrape_streaming(provider, exam_code, output_path, detail_options, settings,
+                                                       known_urls=known_urls, fan_out=not incremental)
+            # The questions of failed listing pages are missing: keep the journal for --resume
+            failed_pages = crawler.stats.get_value('examtopics/listing_pages_failed', 0)
+            complete = crawler.stats.get_value('finish_reason') == 'finished' and not failed_pages
+        finally:
+            if journal:
+                journal.finish(complete)
+            if refresh:
+                finish_refresh(refresh, output_csv, output_path, changes_path, complete)
+            if crawler:
+                run_stats.merge_scrapy(crawler.stats.get_stats())
+
+    # Questions of failed listing pages, and failed questions, must stay new to the next incremental run
+    if watermark and complete:
+        failed_questions = journal.failed if journal else crawler.stats.get_value('examtopics/detail_errors', 0)
+        if failed_questions:
+            print(f"{failed_questions} questions failed: {state_path} was not advanced, "
+                  f"the next incremental run retries them.", file=sys.stderr)
+        else:
+            watermark.update(provider, exam_code, crawler.spider.newest_urls)
+            watermark.save()
+
+    if failed_pages:
+        print(f"{failed_pages} listing pages could not be fetched: their questions are missing from {output_csv}.",
+              file=sys.stderr)
+        raise typer.Exit(code=1)
+
+    if not item_count:
+        if known_urls is not None:
+            print("\nNo new questions since the last run.")
+            return
+        print("No items were collected during the scrape. Check the spider logs.", file=sys.stderr)
+        raise typer.Exit(code=1)
+
+    print(f"\nScraping finished. Processed {item_count} question URLs.")
+    print(f"Successfully processed data and saved to {output_csv}")
+
+
+def scrape_streaming(provider: str, exam_code: str, output_csv: Path, detail_options: dict, settings: 'Settings',
+                     known_urls=None, fan_out=True):
+    """
+    Crawls the listing while a background thread fetches the question pages
+    streamed by the spider. Returns the crawler and the number of questions.
+    """
+    from scrapy.crawler import CrawlerProcess
+    from examtopics_scraper.exporters import HANDOFF_QUEUE_SIZE
+    from examtopics_scraper.spiders import ExamtopicsQuestionsSpider
+
+    # Configure Scrapy to hand items over to the detail stage
     settings['ITEM_PIPELINES'] = {
-        'examtopics_scraper.exporters.ItemCollectorPipeline': 1
+        'examtopics_scraper.exporters.ItemQueuePipeline': 1
     }
     settings['LOG_LEVEL'] = 'INFO'
     settings['ROBOTSTXT_OBEY'] = False
 
-    # Connect the signal handler *before* starting the process
-    dispatcher.connect(spider_closed_handler, signal=signals.spider_closed)
+    cache = cache_from_settings(settings)
+    item_queue = queue.Queue(maxsize=HANDOFF_QUEUE_SIZE)
+    worker, outcome = start_detail_worker(item_queue, output_csv, detail_options, cache,
+                                          append=known_urls is not None)
 
     process = CrawlerProcess(settings)
-    process.crawl(ExamtopicsQuestionsSpider, provider=provider, exam_code=exam_code)
+    crawler = process.create_crawler(ExamtopicsQuestionsSpider)
+    process.crawl(crawler, provider=provider, exam_code=exam_code, item_queue=item_queue, known_urls=known_urls,
+                  fan_out=fan_out)
 
     try:
         # This starts the Scrapy event loop and blocks until the crawl is finished
         process.start()
     except Exception as e:
         print(f"An error occurred during the scraping crawl: {e}", file=sys.stderr)
-        # Disconnect signal handler on error
-        dispatcher.disconnect(spider_closed_handler, signal=signals.spider_closed)
         raise typer.Exit(code=1)
+    finally:
+        # Scrapy's handler would swallow Ctrl-C while waiting for the detail stage
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # Signal end-of-stream and let the detail stage finish the remaining items
+        item_queue.put(None)
+        worker.join()
+        if cache:
+            cache.close()
 
-    # Disconnect the signal handler now that the crawl is done
-    dispatcher.disconnect(spider_closed_handler, signal=signals.spider_closed)
-
-    # --- Processing Step ---
-    if not collected_items_global:
-        print("No items were collected during the scrape. Check the spider logs.", file=sys.stderr)
+    if outcome['error'] is not None:
+        print(f"An error occurred during data processing: {outcome['error']}", file=sys.stderr)
         raise typer.Exit(code=1)
 
-    print(f"\nScraping finished. Collected {len(collected_items_global)} question URLs.")
-    print("Starting data processing...")
+    return crawler, outcome['items']
 
+
+def process_indexed_questions(questions, output_csv: Path, detail_options: dict, settings: 'Settings'):
+    """Runs only the detail stage, for questions already resolved from an index."""
+    from examtopics_scraper.processing import process_question_data
+
+    if not questions:
+        print("No questions of this exam were found in the index.", file=sys.stderr)
+        raise typer.Exit(code=1)
+
+    cache = cache_from_settings(settings)
     try:
-        process_question_data(collected_items_global, str(output_csv))
-        print(f"\nSuccessfully processed data and saved to {output_csv}")
+        process_question_data(questions.drain(), str(output_csv), cache=cache, **detail_options)
     except Exception as e:
         print(f"An error occurred during data processing: {e}", file=sys.stderr)
         raise typer.Exit(code=1)
+    finally:
+        if cache:
+            cache.close()
+    print(f"Successfully processed data and saved to {output_csv}")
+
+
+def scrape_in_reactor(provider: str, exam_code: str, output_csv: Path, concurrency: int, settings: 'Settings',
+                      questions=None, known_urls=None, fan_out=True, max_retries=DEFAULT_MAX_RETRIES,
+                      output_format=None):
+    """
+    Runs the whole `scrape` workflow inside Scrapy: question pages are
+    requested by the spider and written by ExamtopicsQuestionDetailsCsvPipeline.
+    If `questions` were resolved from an index, the listing is not crawled.
+    Returns the crawler and the number of questions.
+    """
+    from scrapy.crawler import CrawlerProcess
+    from examtopics_scraper.spiders import ExamtopicsQuestionsSpider
+
+    settings['ITEM_PIPELINES'] = {
+        'examtopics_scraper.exporters.ExamtopicsQuestionDetailsCsvPipeline': 1
+    }
+    settings['CSV_OUTPUT_PATH'] = str(output_csv)
+    settings['CSV_OUTPUT_APPEND'] = known_urls is not None
+    settings['CSV_OUTPUT_FORMAT'] = output_format
+    settings['LOG_LEVEL'] = 'INFO'
+    settings['ROBOTSTXT_OBEY'] = False
+    settings['CONCURRENT_REQUESTS'] = concurrency
+    settings['CONCURRENT_REQUESTS_PER_DOMAIN'] = concurrency
+    settings['DOWNLOAD_TIMEOUT'] = REQUEST_TIMEOUT
+    settings['AUTOTHROTTLE_ENABLED'] = True
+    settings['AUTOTHROTTLE_TARGET_CONCURRENCY'] = concurrency
+    # Like the requests engine's AdaptiveLimiter, send at once and only slow
+    # down on latency: AutoThrottle would otherwise start from a 5 s delay
+    settings['AUTOTHROTTLE_START_DELAY'] = 0
+    settings['DOWNLOAD_DELAY'] = 0
+    settings['RETRY_TIMES'] = max_retries # RetryMiddleware already retries 429 and 5xx
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(ExamtopicsQuestionsSpider)
+    process.crawl(crawler, provider=provider, exam_code=exam_code, fetch_details=True,
+                  questions=questions.drain() if questions is not None else None,
+                  known_urls=known_urls, fan_out=fan_out)
+
+    try:
+        process.start()
+    except Exception as e:
+        print(f"An error occurred during the scraping crawl: {e}", file=sys.stderr)
+        raise typer.Exit(code=1)
+
+    return crawler, crawler.stats.get_value('item_scraped_count', 0)
+
+
+@app.command("build-index")
+def build_index(
+    provider: str = typer.Argument(..., help="The exam provider code (e.g., 'microsoft', 'amazon')."),
+    index_path: Path = typer.Option(
+        ..., "--index",
+        help="SQLite file holding the provider discussion index.",
+        resolve_path=True,
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
+):
+    """
+    Crawls the whole discussion listing of a provider once and indexes every
+    discussion link, so that exams can be scraped without crawling it again.
+    """
+    print(f"Indexing discussions of provider: {provider}...")
+    settings = new_settings()
+    configure_cache(settings, cache_path, offline=offline)
+    crawl_discussion_index(provider, index_path, settings)
+
+
+@app.command("scrape-many")
+def scrape_many(
+    provider: str = typer.Argument(..., help="The exam provider code (e.g., 'microsoft', 'amazon')."),
+    exam_codes: List[str] = typer.Argument(..., help="One or more exam codes of the provider."),
+    output_dir: Path = typer.Option(
+        ..., "--output-dir", "-d",
+        help="Directory where one file per exam (<exam code>.csv, or the --format extension) will be saved.",
+        file_okay=False,
+        resolve_path=True,
+    ),
+    index_path: Optional[Path] = typer.Option(
+        None, "--index",
+        help="Provider index to use; built by a single listing crawl if missing. "
+             "Defaults to <output dir>/<provider>-index.sqlite.",
+        resolve_path=True,
+    ),
+    rebuild_index: bool = typer.Option(False, "--rebuild-index", help="Crawl the listing again even if the index is complete."),
+    concurrency: int = typer.Option(
+        DEFAULT_CONCURRENCY,
+        "--concurrency", "-c",
+        min=1,
+        help="Maximum number of question pages fetched at the same time. Higher is faster but more likely to get blocked.",
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
+    output_format: Optional[OutputFormat] = typer.Option(
+        None, "--format",
+        help="Output file format. Defaults to the format of the output file extension, CSV otherwise. "
+             "Parquet requires pyarrow (pip install examtopics_scraper[parquet]).",
+    ),
+    max_retries: int = typer.Option(
+        DEFAULT_MAX_RETRIES, "--max-retries", min=0,
+        help="Retries of a question page on timeouts, 429 and 5xx responses before it is left empty.",
+    ),
+    resume: bool = typer.Option(
+        False, "--resume",
+        help="Continue interrupted exams from their journals (<exam code>.<ext>.journal), fetching only the "
+             "failed or missing questions.",
+    ),
+    refresh_output: bool = typer.Option(
+        False, "--refresh",
+        help="Refresh the existing exam files with conditional requests, writing each exam's added, changed "
+             "and removed questions to <exam file>.changes.jsonl.",
+    ),
+    stats_path: Optional[Path] = typer.Option(
+        None, "--stats",
+        help="Write the counters and timings of the run (all exams) to this file at exit: "
+             "a Prometheus textfile if it ends with .prom, JSON otherwise.",
+        resolve_path=True,
+    ),
+    profile_path: Optional[Path] = typer.Option(
+        None, "--profile",
+        help="Profile the run with cProfile, including the fetch threads, and write the pstats dump here.",
+        resolve_path=True,
+    ),
+):
+    """
+    Scrapes several exams of the same provider from a single crawl of its
+    discussion listing, saving one output file per exam.
+    """
+    from examtopics_scraper.index import DiscussionIndex
+
+    if refresh_output and resume:
+        print("--refresh cannot be combined with --resume.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    index_path = index_path or output_dir / f"{provider}-index.sqlite"
+
+    settings = new_settings()
+    configure_cache(settings, cache_path, offline=offline)
+
+    with run_report(stats_path, profile_path) as run_stats:
+        index = DiscussionIndex(str(index_path))
+        needs_crawl = rebuild_index or index.completed_at(provider) is None
+        index.close()
+        if needs_crawl:
+            # The only crawl of this run: the reactor cannot be restarted afterwards
+            crawler = crawl_discussion_index(provider, index_path, settings)
+            run_stats.merge_scrapy(crawler.stats.get_stats())
+
+        failed = []
+        for exam_code in exam_codes:
+            file_name = re.sub(r"[^\w.-]+", "_", exam_code) # Exam codes may contain spaces
+            output_csv = output_dir / f"{file_name}.{(output_format or OutputFormat.csv).value}"
+            print(f"\n--- {provider}/{exam_code} -> {output_csv} ---")
+            output_path, journal, refresh = output_csv, None, None
+            if refresh_output:
+                refresh, output_path = start_refresh(output_csv, output_format)
+            else:
+                journal = open_journal(output_csv, resume)
+            complete = False
+            try:
+                questions = load_indexed_questions(index_path, provider, exam_code)
+                detail_options = {'concurrency': concurrency, 'journal': journal, 'max_retries': max_retries,
+                                  'stats': run_stats, 'output_format': output_format, 'refresh': refresh}
+                process_indexed_questions(questions, output_path, detail_options, settings)
+                complete = True
+            except typer.Exit:
+                failed.append(exam_code)
+            finally:
+                if journal:
+                    journal.finish(complete)
+                if refresh:
+                    finish_refresh(refresh, output_csv, output_path, None, complete)
+
+        if failed:
+            print(f"\nFailed exams: {', '.join(failed)}", file=sys.stderr)
+            raise typer.Exit(code=1)
+
+
+@app.command("serve")
+def serve(
+    output_dir: Path = typer.Option(
+        ..., "--output-dir", "-d",
+        help="Directory the outputs of scrape jobs are written to.",
+        file_okay=False,
+        resolve_path=True,
+    ),
+    host: str = typer.Option("127.0.0.1", "--host", help="Interface the job API listens on."),
+    port: int = typer.Option(8765, "--port", "-p", help="Port the job API listens on."),
+    max_jobs: int = typer.Option(
+        DEFAULT_MAX_JOBS, "--max-jobs", min=1,
+        help="Jobs running at the same time; later ones wait for a free slot.",
+    ),
+    concurrency: int = typer.Option(
+        DEFAULT_CONCURRENCY,
+        "--concurrency", "-c",
+        min=1,
+        help="Default maximum number of question pages a scrape job fetches at the same time.",
+    ),
+    max_retries: int = typer.Option(
+        DEFAULT_MAX_RETRIES, "--max-retries", min=0,
+        help="Default retries of a question page on timeouts, 429 and 5xx responses before it is left empty.",
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across jobs and runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
+):
+    """
+    Runs list-exams and scrape jobs submitted to a local HTTP/JSON API
+    (POST /jobs, GET /jobs/<id>) in one long-running process, keeping the
+    reactor, connection pools and cache warm between jobs.
+    """
+    from examtopics_scraper.service import ScrapeService
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    settings = new_settings()
+    settings['LOG_LEVEL'] = 'INFO'
+    settings['ROBOTSTXT_OBEY'] = False
+    configure_cache(settings, cache_path, offline=offline)
+    ScrapeService(settings, output_dir, max_jobs=max_jobs, concurrency=concurrency,
+                  max_retries=max_retries).serve(host, port)
+
+
+def open_work_queue(queue_path: Path, shard_size: Optional[int] = None):
+    """Opens (or creates) the work queue at `queue_path`, with `shard_size` questions per shard if given."""
+    from examtopics_scraper.workqueue import WorkQueue
+
+    return WorkQueue(str(queue_path), shard_size) if shard_size else WorkQueue(str(queue_path))
+
+
+def print_queue_progress(work_queue):
+    """Prints the shard and question counts of `work_queue` by status, and whether it is sealed."""
+    progress = work_queue.progress()
+    print(f"Work queue: shards {progress['shards'] or '{}'}, questions {progress['questions'] or '{}'}"
+          f"{'' if progress['sealed'] else ', listing not complete'}.")
+
+
+@app.command("coordinate")
+def coordinate(
+    provider: str = typer.Argument(..., help="The exam provider code (e.g., 'microsoft', 'amazon')."),
+    exam_code: str = typer.Argument(..., help="The specific exam code (e.g., 'az-900')."),
+    queue_path: Path = typer.Option(
+        ..., "--queue",
+        help="SQLite work queue shared with the workers: a local file, or one on a network filesystem "
+             "with reliable locks.",
+        resolve_path=True,
+    ),
+    shard_size: int = typer.Option(
+        DEFAULT_SHARD_SIZE, "--shard-size", min=1,
+        help="Questions per shard, the unit of work a worker claims at once.",
+    ),
+    index_path: Optional[Path] = typer.Option(
+        None, "--index",
+        help="Resolve the question URLs from a provider index built by build-index instead of crawling the listing.",
+        resolve_path=True,
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
+):
+    """
+    Fills a shared work queue with the question URLs of an exam, in shards.
+    Workers (`work`) can run at the same time, on this machine or on others
+    sharing the queue file through a filesystem with reliable locks; `merge`
+    writes the ordered output once they are done. Re-running it after an
+    interruption only adds the questions not queued yet.
+    """
+    queue_path.parent.mkdir(parents=True, exist_ok=True)
+    work_queue = open_work_queue(queue_path, shard_size)
+    try:
+        if index_path:
+            questions = load_indexed_questions(index_path, provider, exam_code)
+            work_queue.begin(provider, exam_code)
+            print(f"Queued {work_queue.add(questions.drain())} new questions.")
+            work_queue.seal()
+        else:
+            from scrapy.crawler import CrawlerProcess
+            from examtopics_scraper.spiders import ExamtopicsQuestionsSpider
+
+            settings = new_settings()
+            configure_cache(settings, cache_path, offline=offline)
+            settings['ITEM_PIPELINES'] = {
+                'examtopics_scraper.exporters.WorkQueuePipeline': 1
+            }
+            settings['WORK_QUEUE_PATH'] = str(queue_path)
+            settings['WORK_QUEUE_SHARD_SIZE'] = shard_size
+            settings['LOG_LEVEL'] = 'INFO'
+            settings['ROBOTSTXT_OBEY'] = False
+
+            process = CrawlerProcess(settings)
+            crawler = process.create_crawler(ExamtopicsQuestionsSpider)
+            process.crawl(crawler, provider=provider, exam_code=exam_code)
+            try:
+                process.start()
+            except Exception as e:
+                print(f"An error occurred during the scraping crawl: {e}", file=sys.stderr)
+                raise typer.Exit(code=1)
+            if crawler.stats.get_value('finish_reason') != 'finished':
+                print(f"The listing crawl did not finish ({crawler.stats.get_value('finish_reason')}); "
+                      f"re-run coordinate to complete the queue.", file=sys.stderr)
+                raise typer.Exit(code=1)
+        print_queue_progress(work_queue)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        raise typer.Exit(code=1)
+    finally:
+        work_queue.close()
+
+
+@app.command("work")
+def work(
+    queue_path: Path = typer.Option(
+        ..., "--queue",
+        help="SQLite work queue filled by coordinate.",
+        exists=True, dir_okay=False, resolve_path=True,
+    ),
+    worker_id: Optional[str] = typer.Option(
+        None, "--worker-id",
+        help="Name of this worker in the leases. Defaults to <host name>-<process id>.",
+    ),
+    concurrency: int = typer.Option(
+        DEFAULT_CONCURRENCY,
+        "--concurrency", "-c",
+        min=1,
+        help="Maximum number of question pages fetched at the same time by this worker.",
+    ),
+    max_retries: int = typer.Option(
+        DEFAULT_MAX_RETRIES, "--max-retries", min=0,
+        help="Retries of a question page on timeouts, 429 and 5xx responses before it counts as failed.",
+    ),
+    lease_seconds: float = typer.Option(
+        DEFAULT_LEASE_SECONDS, "--lease-seconds", min=1,
+        help="Lease of a claimed shard, renewed while the worker is alive. A crashed worker's shards are "
+             "reclaimed by other workers after it expires.",
+    ),
+    max_attempts: int = typer.Option(
+        DEFAULT_MAX_ATTEMPTS, "--max-attempts", min=1,
+        help="Leases of a shard with failed questions (or crashed workers) before they are given up.",
+    ),
+    cache_path: Optional[Path] = typer.Option(
+        None, "--cache",
+        help="SQLite file caching downloaded pages across runs.",
+        resolve_path=True,
+    ),
+    offline: bool = typer.Option(False, "--offline", help="Serve pages only from the cache, never from the network."),
+    stats_path: Optional[Path] = typer.Option(
+        None, "--stats",
+        help="Write the counters and timings of this worker to this file at exit: "
+             "a Prometheus textfile if it ends with .prom, JSON otherwise.",
+        resolve_path=True,
+    ),
+    profile_path: Optional[Path] = typer.Option(
+        None, "--profile",
+        help="Profile the worker with cProfile, including the fetch threads, and write the pstats dump here.",
+        resolve_path=True,
+    ),
+):
+    """
+    Claims shards of a work queue and fetches their question pages until
+    every shard is done. Run as many workers as needed, as processes or on
+    other machines sharing the queue file (see coordinate).
+    """
+    import socket
+    from examtopics_scraper.workqueue import run_worker
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    settings = new_settings()
+    configure_cache(settings, cache_path, offline=offline)
+    cache = cache_from_settings(settings)
+    work_queue = open_work_queue(queue_path)
+    print(f"Worker {worker_id} on {queue_path}.")
+    try:
+        with run_report(stats_path, profile_path) as run_stats:
+            completed = run_worker(work_queue, worker_id, concurrency=concurrency, max_retries=max_retries,
+                                   lease_seconds=lease_seconds, max_attempts=max_attempts, cache=cache,
+                                   stats=run_stats)
+        print(f"Worker {worker_id} done: {completed} shards completed.")
+        print_queue_progress(work_queue)
+    finally:
+        work_queue.close()
+        if cache:
+            cache.close()
+
+
+@app.command("merge")
+def merge(
+    queue_path: Path = typer.Option(
+        ..., "--queue",
+        help="SQLite work queue whose shards are all done.",
+        exists=True, dir_okay=False, resolve_path=True,
+    ),
+    output_csv: Path = typer.Option(
+        ..., "--output", "-o",
+        help="Path to the output file: CSV, or JSON Lines (.jsonl) or Parquet (.parquet) by extension or --format.",
+    ),
+    output_format: Optional[OutputFormat] = typer.Option(
+        None, "--format",
+        help="Output file format. Defaults to the format of the output file extension, CSV otherwise.",
+    ),
+):
+    """
+    Writes the rows returned by the workers to the output file, in listing
+    order.
+    """
+    from examtopics_scraper.processing import OUTPUT_HEADER
+    from examtopics_scraper.writers import open_writer
+
+    work_queue = open_work_queue(queue_path)
+    try:
+        if not work_queue.is_finished():
+            print_queue_progress(work_queue)
+            print("The work queue is not finished yet: wait for the coordinator and the workers.", file=sys.stderr)
+            raise typer.Exit(code=1)
+        output_csv.parent.mkdir(parents=True, exist_ok=True)
+        with open_writer(str(output_csv), OUTPUT_HEADER, output_format=output_format) as writer:
+            writer.write_rows(work_queue.rows())
+        failed = work_queue.progress()['questions'].get('failed', 0)
+    finally:
+        work_queue.close()
+    print(f"Merged {writer.row_count} questions ({failed} failed) into {output_csv}")
 
 
 if __name__ == "__main__":
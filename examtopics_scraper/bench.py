@@ -0,0 +1,473 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import typer
+
+# --- Typer sub-app for the `bench` command group ---
+app = typer.Typer(
+    name="bench",
+    help="Benchmarks for the scraper's hot paths.",
+    no_args_is_help=True,
+)
+
+
+def load_pages(pages_dir: Path, repeat: int = 1) -> List[bytes]:
+    """Loads every saved *.html page in `pages_dir`, `repeat` times over."""
+    pages = [path.read_bytes() for path in sorted(pages_dir.glob("*.html"))]
+    if not pages:
+        print(f"No *.html pages found in {pages_dir}.", file=sys.stderr)
+        raise typer.Exit(code=1)
+    return pages * repeat
+
+
+def time_pages(label: str, run: Callable[[], None], page_count: int, cores: int = 1) -> float:
+    """Times `run` over `page_count` pages and prints pages/s and pages/s per core."""
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    rate = page_count / elapsed
+    print(f"{label:<32} {rate:10.1f} pages/s {rate / cores:10.1f} pages/s/core  ({elapsed:.2f} s)")
+    return rate
+
+
+@app.command("extract")
+def bench_extract(
+    pages_dir: Path = typer.Argument(
+        ..., help="Directory of saved question pages (*.html).",
+        exists=True, file_okay=False, resolve_path=True,
+    ),
+    repeat: int = typer.Option(1, "--repeat", "-r", min=1, help="Process the pages this many times over."),
+    workers: Optional[int] = typer.Option(
+        None, "--workers", "-w", min=1,
+        help="Processes for the process-pool run. Defaults to the number of CPUs.",
+    ),
+):
+    """
+    Measures question page extraction throughput on saved pages: the legacy
+    per-field XPATHS evaluation, the compiled single-pass extractor, and the
+    compiled extractor on a process pool.
+    """
+    # Imported here so `bench` does not slow down the other commands
+    from lxml import html
+
+    from examtopics_scraper.extraction import extract_question, extract_questions
+    from examtopics_scraper.processing import XPATHS, extract_data
+
+    pages = load_pages(pages_dir, repeat)
+    workers = workers or os.cpu_count() or 1
+    print(f"Extracting {len(pages)} pages ({sum(map(len, pages)) / 2**20:.1f} MiB)...")
+
+    def legacy():
+        for page in pages:
+            tree = html.fromstring(page)
+            for xpath in XPATHS.values():
+                extract_data(tree, xpath)
+
+    def compiled():
+        for page in pages:
+            extract_question(page)
+
+    def pooled():
+        for _ in extract_questions(pages, workers=workers):
+            pass
+
+    legacy_rate = time_pages("legacy XPATHS, 1 process", legacy, len(pages))
+    compiled_rate = time_pages("compiled, 1 process", compiled, len(pages))
+    time_pages(f"compiled, {workers} processes", pooled, len(pages), cores=workers)
+    print(f"Compiled single-pass speed-up: {compiled_rate / legacy_rate:.2f}x")
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Nearest-rank percentile of `values` (0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100)) # ceil without math
+    return ordered[int(rank) - 1]
+
+
+def run_cli(args: List[str], base_url: str, verbose: bool = False) -> Tuple[float, float, int]:
+    """
+    Runs `examtopics-scraper --base-url BASE_URL ARGS` in a fresh interpreter
+    (Scrapy's reactor runs once per process). Returns wall time in seconds,
+    peak RSS in MiB and the exit code.
+    """
+    output = None if verbose else subprocess.DEVNULL
+    command = [sys.executable, "-m", "examtopics_scraper", "--base-url", base_url, *args]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=output, stderr=output)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    peak_rss = usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    return wall, peak_rss, process.returncode
+
+
+def span_rate(requests: List[tuple]) -> float:
+    """Requests per second between the first request start and the last request end."""
+    if not requests:
+        return 0.0
+    span = max(end for _, end, _ in requests) - min(start for start, _, _ in requests)
+    return len(requests) / span if span > 0 else float(len(requests))
+
+
+def fake_site_config(exams: int, pages: int, per_page: int, latency_ms: float, jitter_ms: float,
+                     error_rate: float, rate_limit_rate: float, page_kb: int, seed: int, revision: int = 0):
+    from examtopics_scraper.fakesite import FakeSiteConfig
+    return FakeSiteConfig(exams=exams, listing_pages=pages, discussions_per_page=per_page,
+                          latency=latency_ms / 1000, latency_jitter=jitter_ms / 1000,
+                          error_rate=error_rate, rate_limit_rate=rate_limit_rate,
+                          page_size=page_kb * 1024, seed=seed, revision=revision)
+
+
+@app.command("serve")
+def bench_serve(
+    port: int = typer.Option(8000, "--port", "-p", help="Port to listen on."),
+    exams: int = typer.Option(5, "--exams", min=1, help="Exams per provider (codes EX-0, EX-1, ...)."),
+    pages: int = typer.Option(50, "--pages", min=1, help="Discussion listing pages per provider."),
+    per_page: int = typer.Option(20, "--per-page", min=1, help="Discussions per listing page."),
+    latency_ms: float = typer.Option(0, "--latency-ms", min=0, help="Latency added to every response."),
+    jitter_ms: float = typer.Option(0, "--jitter-ms", min=0, help="Up to this much extra random latency."),
+    error_rate: float = typer.Option(0, "--error-rate", min=0, max=1, help="Share of 500 responses."),
+    rate_limit_rate: float = typer.Option(0, "--rate-limit-rate", min=0, max=1, help="Share of 429 responses."),
+    page_kb: int = typer.Option(50, "--page-kb", min=1, help="Approximate size of question pages."),
+    seed: int = typer.Option(0, "--seed", help="Seed of the synthetic content and error injection."),
+    revision: int = typer.Option(0, "--revision", min=0, help="Content revision: changes every 10th question."),
+):
+    """
+    Serves a local stand-in ExamTopics site until interrupted, for use with
+    --base-url.
+    """
+    from examtopics_scraper.fakesite import FakeSite
+
+    config = fake_site_config(exams, pages, per_page, latency_ms, jitter_ms, error_rate, rate_limit_rate,
+                              page_kb, seed, revision)
+    site = FakeSite(config, port=port)
+    print(f"Serving a fake ExamTopics site on {site.base_url} (Ctrl-C to stop)...")
+    try:
+        site.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        site.stop()
+
+
+@app.command("e2e")
+def bench_e2e(
+    exams: int = typer.Option(5, "--exams", min=1, help="Exams per provider (codes EX-0, EX-1, ...)."),
+    pages: int = typer.Option(50, "--pages", min=1, help="Discussion listing pages per provider."),
+    per_page: int = typer.Option(20, "--per-page", min=1, help="Discussions per listing page."),
+    latency_ms: float = typer.Option(20, "--latency-ms", min=0, help="Latency added to every response."),
+    jitter_ms: float = typer.Option(10, "--jitter-ms", min=0, help="Up to this much extra random latency."),
+    error_rate: float = typer.Option(0, "--error-rate", min=0, max=1, help="Share of 500 responses."),
+    rate_limit_rate: float = typer.Option(0, "--rate-limit-rate", min=0, max=1, help="Share of 429 responses."),
+    page_kb: int = typer.Option(50, "--page-kb", min=1, help="Approximate size of question pages."),
+    seed: int = typer.Option(0, "--seed", help="Seed of the synthetic content and error injection."),
+    scrape_args: Optional[List[str]] = typer.Option(
+        None, "--scrape-arg",
+        help="Extra argument for the scrape command, repeatable (e.g. --scrape-arg=--engine=scrapy).",
+    ),
+    json_path: Optional[Path] = typer.Option(None, "--json", help="Also write the results to this JSON file."),
+    max_wall: Optional[float] = typer.Option(
+        None, "--max-wall", min=0,
+        help="Exit with code 1 if the total wall time exceeds this many seconds (for CI).",
+    ),
+    verbose: bool = typer.Option(False, "--verbose", "-v", help="Show the output of the benchmarked commands."),
+):
+    """
+    Runs list-exams and scrape against a local stand-in ExamTopics site and
+    reports listing pages/s, questions/s, request latency percentiles, peak
+    RSS and wall time.
+    """
+    from examtopics_scraper.fakesite import FakeSite, exam_code
+
+    config = fake_site_config(exams, pages, per_page, latency_ms, jitter_ms, error_rate, rate_limit_rate,
+                              page_kb, seed)
+    site = FakeSite(config)
+    base_url = site.start()
+    results: Dict[str, object] = {"config": asdict(config)}
+    failed = False
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            runs = {
+                "list_exams": ["list-exams", "fake"],
+                "scrape": ["scrape", "fake", exam_code(0), "-o", str(Path(work_dir) / "questions.csv"),
+                           *(scrape_args or [])],
+            }
+            for name, args in runs.items():
+                site.stats.reset()
+                wall, peak_rss, exit_code = run_cli(args, base_url, verbose)
+                requests = site.stats.snapshot()
+                latencies = [(end - start) * 1000 for served in requests.values() for start, end, _ in served]
+                results[name] = {
+                    "wall_s": round(wall, 3),
+                    "peak_rss_mib": round(peak_rss, 1),
+                    "exit_code": exit_code,
+                    "requests": {kind: len(served) for kind, served in requests.items()},
+                    "bytes_served": sum(size for served in requests.values() for _, _, size in served),
+                    "statuses": dict(site.stats.statuses),
+                    "latency_ms": {f"p{p}": round(percentile(latencies, p), 2) for p in (50, 95, 99)},
+                }
+                if name == "scrape":
+                    results[name]["listing_pages_per_s"] = round(span_rate(requests["listing"]), 1)
+                    results[name]["questions_per_s"] = round(span_rate(requests["question"]), 1)
+                failed = failed or exit_code != 0
+    finally:
+        site.stop()
+
+    results["total_wall_s"] = round(sum(results[name]["wall_s"] for name in ("list_exams", "scrape")), 3)
+    scrape = results["scrape"]
+    print(f"Fake site: {config.listing_pages} listing pages x {config.discussions_per_page} discussions, "
+          f"{config.exams} exams, {latency_ms:g}+{jitter_ms:g} ms latency")
+    for name in ("list_exams", "scrape"):
+        run = results[name]
+        print(f"{name:<11} wall {run['wall_s']:8.2f} s  peak RSS {run['peak_rss_mib']:7.1f} MiB  "
+              f"exit {run['exit_code']}  requests {run['requests']}")
+    print(f"listing pages/s {scrape['listing_pages_per_s']:.1f}, questions/s {scrape['questions_per_s']:.1f}")
+    latency = scrape["latency_ms"]
+    print(f"scrape request latency p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, "
+          f"p99 {latency['p99']:.1f} ms")
+    print(f"total wall time {results['total_wall_s']:.2f} s")
+
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Results written to {json_path}")
+    if failed:
+        print("A benchmarked command failed (re-run with --verbose).", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if max_wall is not None and results["total_wall_s"] > max_wall:
+        print(f"Total wall time above --max-wall {max_wall} s.", file=sys.stderr)
+        raise typer.Exit(code=1)
+
+
+# Modules that must not be imported just to print help: Scrapy/Twisted startup
+# alone costs more than the rest of the CLI
+HEAVY_MODULES = ("scrapy", "twisted", "requests", "lxml", "pyarrow")
+
+
+def heavy_imports(args: List[str]) -> List[str]:
+    """HEAVY_MODULES imported by `examtopics-scraper ARGS`, from `python -X importtime`."""
+    command = [sys.executable, "-X", "importtime", "-m", "examtopics_scraper", *args]
+    stderr = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    # Lines look like "import time:   self [us] | cumulative | <indent>package.module"
+    imported = {line.rsplit("|", 1)[1].strip().split(".")[0] for line in stderr.splitlines()
+                if line.startswith("import time:") and line.count("|") == 2}
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+@app.command("startup")
+def bench_startup(
+    runs: int = typer.Option(5, "--runs", "-n", min=1, help="Runs of each command; the median is reported."),
+    json_path: Optional[Path] = typer.Option(None, "--json", help="Also write the results to this JSON file."),
+    max_ms: Optional[float] = typer.Option(
+        None, "--max-ms", min=0,
+        help="Exit with code 1 if the median startup time of any command exceeds this many milliseconds (for CI).",
+    ),
+    verbose: bool = typer.Option(False, "--verbose", "-v", help="Show the output of the benchmarked commands."),
+):
+    """
+    Measures the cold start of the CLI in fresh interpreters: the wall time
+    of --help and of the list-exams and scrape help, and the time list-exams
+    and scrape take to send their first request to a local stand-in site.
+    Also fails if printing help imports Scrapy, Twisted, requests or lxml.
+    """
+    from examtopics_scraper.fakesite import FakeSite, FakeSiteConfig, exam_code
+
+    site = FakeSite(FakeSiteConfig(exams=1, listing_pages=1, discussions_per_page=5, page_size=5 * 1024))
+    base_url = site.start()
+    results: Dict[str, Dict[str, object]] = {}
+    failed = False
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            cases = {
+                "help": ["--help"],
+                "list_exams_help": ["list-exams", "--help"],
+                "scrape_help": ["scrape", "--help"],
+                "list_exams": ["list-exams", "fake"],
+                "scrape": ["scrape", "fake", exam_code(0), "-o", str(Path(work_dir) / "questions.csv")],
+            }
+            for name, args in cases.items():
+                startups, walls = [], []
+                for _ in range(runs):
+                    site.stats.reset()
+                    start = time.perf_counter()
+                    wall, _, exit_code = run_cli(args, base_url, verbose)
+                    failed = failed or exit_code != 0
+                    walls.append(wall * 1000)
+                    if name.endswith("help"):
+                        startups.append(wall * 1000)
+                    else:
+                        # Up to the first request the fake site receives
+                        first = min((request_start for served in site.stats.snapshot().values()
+                                     for request_start, _, _ in served), default=start + wall)
+                        startups.append((first - start) * 1000)
+                results[name] = {
+                    "startup_ms": round(percentile(startups, 50), 1),
+                    "startup_min_ms": round(min(startups), 1),
+                    "wall_ms": round(percentile(walls, 50), 1),
+                }
+                if name.endswith("help"):
+                    results[name]["heavy_imports"] = heavy_imports(["--base-url", base_url, *args])
+    finally:
+        site.stop()
+
+    print(f"Median of {runs} runs (startup: wall time for help, time to the first request otherwise)")
+    for name, result in results.items():
+        heavy = result.get("heavy_imports")
+        print(f"{name:<16} startup {result['startup_ms']:8.1f} ms (min {result['startup_min_ms']:7.1f})  "
+              f"wall {result['wall_ms']:8.1f} ms" + (f"  imports {', '.join(heavy)}!" if heavy else ""))
+
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Results written to {json_path}")
+    if failed:
+        print("A benchmarked command failed (re-run with --verbose).", file=sys.stderr)
+        raise typer.Exit(code=1)
+    if any(result.get("heavy_imports") for result in results.values()):
+        print(f"Printing help imports one of {', '.join(HEAVY_MODULES)}: import it inside the command instead.",
+              file=sys.stderr)
+        raise typer.Exit(code=1)
+    slow = [name for name, result in results.items() if max_ms is not None and result["startup_ms"] > max_ms]
+    if slow:
+        print(f"Startup above --max-ms {max_ms:g} ms: {', '.join(slow)}.", file=sys.stderr)
+        raise typer.Exit(code=1)
+
+
+def build_synthetic_index(index_path: Path, base_url: str, discussion_count: int):
+    """Indexes `discussion_count` discussions of the stand-in site's provider 'fake', all of exam EX-0."""
+    from examtopics_scraper.fakesite import FakeSiteConfig, discussion_link
+    from examtopics_scraper.index import DiscussionIndex
+
+    config = FakeSiteConfig(exams=1, listing_pages=discussion_count, discussions_per_page=1)
+    index = DiscussionIndex(str(index_path))
+    try:
+        index.start_crawl("fake")
+        for first in range(0, discussion_count, 10_000):
+            discussions = []
+            for discussion in range(first, min(first + 10_000, discussion_count)):
+                path, title = discussion_link(config, "fake", discussion)
+                discussions.append({"title": title, "url": base_url + path, "page": discussion + 1, "rank": 0})
+            index.add_discussions("fake", discussions)
+        index.finish_crawl("fake")
+    finally:
+        index.close()
+
+
+def question_list_sizes(index_path: Path) -> Dict[str, float]:
+    """
+    Bytes per question, besides its URL, of the question list of EX-0 held
+    as a dict per listing and per detail item (the former representation),
+    as QuestionRecords, and as QuestionColumns.
+    """
+    import tracemalloc
+    from examtopics_scraper.index import DiscussionIndex
+
+    index = DiscussionIndex(str(index_path))
+    try:
+        columns = index.resolve("fake", "EX-0")
+    finally:
+        index.close()
+    # The URLs are shared by every representation, so they are left out of the comparison
+    urls = [record.url for record in columns]
+    questions = [(record.question, record.topic.split()[-1]) for record in columns]
+
+    def dicts():
+        # The spider dicts (topics straight from the regex) and the detail stage's copies
+        items = [{"question": question, "topic": f"topic {topic}", "url": url}
+                 for (question, topic), url in zip(questions, urls)]
+        return items, [{"id": item["question"], "topic": item["topic"], "url": item["url"]} for item in items]
+
+    def records():
+        from examtopics_scraper.records import QuestionRecord, intern_text
+        return [QuestionRecord(question, intern_text(f"topic {topic}"), url)
+                for (question, topic), url in zip(questions, urls)]
+
+    def question_columns():
+        from examtopics_scraper.records import QuestionColumns
+        return QuestionColumns(records())
+
+    sizes = {}
+    for name, build in (("dicts", dicts), ("records", records), ("columns", question_columns)):
+        tracemalloc.start()
+        built = build()
+        sizes[name] = tracemalloc.get_traced_memory()[0] / max(len(urls), 1)
+        del built
+        tracemalloc.stop()
+    return sizes
+
+
+@app.command("memory")
+def bench_memory(
+    discussion_counts: List[int] = typer.Option(
+        [1_000, 5_000, 20_000], "--discussions", "-n", min=1,
+        help="Discussion counts of the synthetic provider (repeat the option for several).",
+    ),
+    page_kb: int = typer.Option(5, "--page-kb", min=1, help="Approximate size of the question pages in KiB."),
+    json_path: Optional[Path] = typer.Option(None, "--json", help="Also write the results to this JSON file."),
+    max_mib: Optional[float] = typer.Option(
+        None, "--max-mib", min=0,
+        help="Exit with code 1 if the peak RSS of any run exceeds this many MiB (for CI).",
+    ),
+    verbose: bool = typer.Option(False, "--verbose", "-v", help="Show the output of the benchmarked commands."),
+):
+    """
+    Measures peak RSS against the number of discussions of a provider. For
+    each count, a stand-in site with that many discussions of one exam is
+    started and indexed, and `scrape --index` fetches every question page in
+    a fresh interpreter, with its journal, reorder window and output writer
+    as in a normal run. Also reports the bytes per question of the former
+    dict items, QuestionRecords and QuestionColumns.
+    """
+    from examtopics_scraper.fakesite import FakeSite, FakeSiteConfig
+
+    results: Dict[str, Dict[str, object]] = {}
+    failed = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        for count in sorted(set(discussion_counts)):
+            site = FakeSite(FakeSiteConfig(exams=1, listing_pages=count, discussions_per_page=1,
+                                           page_size=page_kb * 1024))
+            base_url = site.start()
+            try:
+                index_path = Path(work_dir) / f"index-{count}.sqlite"
+                build_synthetic_index(index_path, base_url, count)
+                args = ["scrape", "fake", "EX-0", "--index", str(index_path),
+                        "-o", str(Path(work_dir) / f"questions-{count}.csv")]
+                wall, peak_rss, exit_code = run_cli(args, base_url, verbose)
+                failed = failed or exit_code != 0
+            finally:
+                site.stop()
+            sizes = question_list_sizes(index_path)
+            results[str(count)] = {
+                "wall_s": round(wall, 2),
+                "peak_rss_mib": round(peak_rss, 1),
+                **{f"{name}_bytes_per_question": round(size, 1) for name, size in sizes.items()},
+            }
+
+    print(f"{'discussions':>11}  {'peak RSS':>12}  {'wall':>8}  bytes/question: {'dicts':>7} {'records':>7} {'columns':>7}")
+    for count, result in results.items():
+        print(f"{count:>11}  {result['peak_rss_mib']:8.1f} MiB  {result['wall_s']:6.2f} s  "
+              f"{'':16}{result['dicts_bytes_per_question']:7.0f} {result['records_bytes_per_question']:7.0f} "
+              f"{result['columns_bytes_per_question']:7.0f}")
+    if len(results) > 1:
+        (low, first), (high, last) = list(results.items())[0], list(results.items())[-1]
+        growth = (last["peak_rss_mib"] - first["peak_rss_mib"]) * 1024 / (int(high) - int(low)) * 1000
+        print(f"Peak RSS grows by {growth:.1f} KiB per 1000 discussions.")
+
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Results written to {json_path}")
+    if failed:
+        print("A benchmarked command failed (re-run with --verbose).", file=sys.stderr)
+        raise typer.Exit(code=1)
+    heavy = [count for count, result in results.items() if max_mib is not None and result["peak_rss_mib"] > max_mib]
+    if heavy:
+        print(f"Peak RSS above --max-mib {max_mib:g} MiB with {', '.join(heavy)} discussions.", file=sys.stderr)
+        raise typer.Exit(code=1)
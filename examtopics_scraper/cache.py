@@ -0,0 +1,147 @@
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+# Default time-to-live (seconds) of cached pages. Discussion listings change
+# every time someone comments, question pages hardly ever do.
+DEFAULT_LISTING_TTL = 60 * 60
+DEFAULT_QUESTION_TTL = 7 * 24 * 60 * 60
+
+# Default cap on the total compressed size of the cache (bytes)
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Eviction empties the cache down to this fraction of its cap, so that it
+# does not run again on the very next insert
+EVICTION_TARGET = 0.9
+# Least recently used entries deleted per eviction query
+EVICTION_BATCH_SIZE = 256
+
+# Access times of cache hits written per commit
+ACCESS_BATCH_SIZE = 256
+
+# Question pages live under /discussions/<provider>/view/<id>-<slug>/
+QUESTION_URL_REGEX = re.compile(r"/discussions/[^/]+/view/")
+
+
+def page_kind(url: str) -> str:
+    """Returns 'question' for question discussion pages, 'listing' otherwise."""
+    return "question" if QUESTION_URL_REGEX.search(url) else "listing"
+
+
+def cache_from_settings(settings) -> Optional["ResponseCache"]:
+    """
+    Opens the cache described by the RESPONSE_CACHE_* entries of Scrapy
+    `settings`, or returns None if RESPONSE_CACHE_PATH is not set.
+    """
+    path = settings.get('RESPONSE_CACHE_PATH')
+    if not path:
+        return None
+    return ResponseCache(
+        path,
+        listing_ttl=settings.getfloat('RESPONSE_CACHE_LISTING_TTL', DEFAULT_LISTING_TTL),
+        question_ttl=settings.getfloat('RESPONSE_CACHE_QUESTION_TTL', DEFAULT_QUESTION_TTL),
+        max_size=settings.getint('RESPONSE_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE),
+        offline=settings.getbool('RESPONSE_CACHE_OFFLINE'),
+    )
+
+
+class ResponseCache:
+    """
+    Persistent cache of page bodies, shared by the spiders and the detail stage.
+
+    Bodies are zlib-compressed and stored in a SQLite file keyed by URL.
+    Listing and question pages expire after different TTLs, and the least
+    recently used entries are evicted once the total compressed size exceeds
+    `max_size`, down to EVICTION_TARGET of it. Access times of cache hits are
+    kept in memory and written in batches, with the next store or on close.
+    In `offline` mode entries never expire, so a previous run can
+    be replayed (e.g. after an XPATHS fix) without touching the network.
+
+    A single instance can be used from several threads.
+    """
+
+    def __init__(self, path: str, listing_ttl: float = DEFAULT_LISTING_TTL,
+                 question_ttl: float = DEFAULT_QUESTION_TTL, max_size: int = DEFAULT_MAX_SIZE,
+                 offline: bool = False):
+        self.path = path
+        self.ttls = {"listing": listing_ttl, "question": question_ttl}
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self._accessed: Dict[str, float] = {} # Access times not written yet, by URL
+
+    def get(self, url: str) -> Optional[bytes]:
+        """Returns the cached body of `url`, or None if missing or expired."""
+        with self._lock:
+            row = self._conn.execute("SELECT kind, body, stored_at FROM responses WHERE url = ?",
+                                     (url,)).fetchone()
+            if row is None:
+                return None
+            kind, body, stored_at = row
+            now = time.time()
+            if not self.offline and now - stored_at > self.ttls[kind]:
+                return None
+            self._accessed[url] = now
+            if len(self._accessed) >= ACCESS_BATCH_SIZE:
+                self._write_access_times()
+                self._conn.commit()
+        return zlib.decompress(body)
+
+    def set(self, url: str, body: bytes):
+        """Stores `body` for `url`, evicting least recently used entries if needed."""
+        compressed = zlib.compress(body)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self._accessed.pop(url, None)
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                               (url, page_kind(url), compressed, len(compressed), now, now))
+            self._size += len(compressed) - (old[0] if old else 0)
+            self._write_access_times()
+            if self._size > self.max_size:
+                self._evict()
+            self._conn.commit()
+
+    def _write_access_times(self):
+        if self._accessed:
+            self._conn.executemany("UPDATE responses SET accessed_at = ? WHERE url = ?",
+                                   ((accessed_at, url) for url, accessed_at in self._accessed.items()))
+            self._accessed.clear()
+
+    def _evict(self):
+        # Drop the least recently used entries, a batch at a time through
+        # responses_accessed, until the cache is down to its eviction target
+        target = self.max_size * EVICTION_TARGET
+        while self._size > target:
+            rows = self._conn.execute("SELECT url, size FROM responses ORDER BY accessed_at LIMIT ?",
+                                      (EVICTION_BATCH_SIZE,)).fetchall()
+            if not rows:
+                break
+            for url, size in rows:
+                if self._size <= target:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._size -= size
+
+    def close(self):
+        with self._lock:
+            self._write_access_times()
+            self._conn.commit()
+            self._conn.close()
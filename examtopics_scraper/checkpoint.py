@@ -0,0 +1,111 @@
+import json
+import os
+import sys
+from typing import Dict, List, Optional
+
+# Completed rows buffered before the journal is flushed and fsync'ed. A hard
+# crash loses at most this many finished questions.
+JOURNAL_BATCH_SIZE = 50
+
+
+class ScrapeJournal:
+    """
+    Append-only JSON Lines journal of the question rows completed by a scrape,
+    kept next to its output until the scrape has fully succeeded.
+
+    The first record holds the output size before the scrape started (non-zero
+    when appending); every other record is ``{"url": ..., "row": [...]}``.
+    Resuming truncates the output back to that size and rewrites it in order,
+    reusing the journaled rows and fetching only the failed or missing ones.
+    Only the offsets of the completed questions' records are kept in memory;
+    their rows are read back from the journal as the output is rewritten.
+    """
+
+    def __init__(self, path: str, resume: bool = False, batch_size: int = JOURNAL_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.output_offset: Optional[int] = None
+        self.offsets: Dict[str, int] = {} # Completed URL -> offset of its record in the journal
+        self.failed = 0
+        self._buffer: List[str] = []
+        if resume and os.path.exists(path):
+            self._load()
+        # Rewrite what was loaded, dropping duplicates and a torn last line
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as journal_file:
+            if self.output_offset is not None:
+                journal_file.write(json.dumps({'output_offset': self.output_offset}).encode('utf-8') + b"\n")
+            if self.offsets:
+                with open(path, 'rb') as previous_file:
+                    for url, offset in self.offsets.items():
+                        previous_file.seek(offset)
+                        self.offsets[url] = journal_file.tell()
+                        journal_file.write(previous_file.readline().rstrip(b"\n") + b"\n")
+        os.replace(tmp_path, path)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._reader = open(path, 'rb')
+
+    def _load(self):
+        offset = 0
+        with open(self.path, 'rb') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    # Only the last line can be torn by a crash
+                    record = {}
+                if 'output_offset' in record:
+                    self.output_offset = record['output_offset']
+                elif 'url' in record:
+                    self.offsets[record['url']] = offset
+                offset += len(line)
+        if self.offsets:
+            print(f"Resuming: {len(self.offsets)} questions already completed in {self.path}.")
+
+    def begin(self, output_offset: int):
+        """Records where the rows of this scrape start in the output (first run only)."""
+        self.output_offset = output_offset
+        self._file.write(json.dumps({'output_offset': output_offset}) + "\n")
+        self.flush()
+
+    def row(self, url: str) -> Optional[List[str]]:
+        """Returns the journaled row of `url`, or None if it still has to be fetched."""
+        offset = self.offsets.get(url)
+        if offset is None:
+            return None
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline())['row']
+
+    def record(self, url: str, row: List[str]):
+        """Journals the row of a successfully processed question."""
+        self._buffer.append(json.dumps({'url': url, 'row': row}) + "\n")
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def record_failure(self):
+        """Counts a question that was not journaled and must be fetched again."""
+        self.failed += 1
+
+    def flush(self):
+        self._file.writelines(self._buffer)
+        self._buffer.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+            self._reader.close()
+
+    def finish(self, complete: bool):
+        """
+        Closes the journal. It is deleted if the scrape is `complete` and no
+        question failed, and kept for a later --resume otherwise.
+        """
+        self.close()
+        if complete and not self.failed:
+            os.remove(self.path)
+        else:
+            print(f"Progress saved in {self.path}: re-run with --resume to fetch only the "
+                  f"failed or missing questions.", file=sys.stderr)
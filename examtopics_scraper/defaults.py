@@ -0,0 +1,22 @@
+# Defaults shared by the CLI options and the scraping modules. This module
+# must stay free of heavy imports (Scrapy, Twisted, requests, lxml): the CLI
+# reads it at startup, before knowing which command runs.
+
+# Site root, overridable with the EXAMTOPICS_BASE_URL setting (e.g. for a local stand-in)
+BASE_URL = "https://www.examtopics.com"
+
+# Default number of question pages fetched concurrently. High enough to hide
+# network latency, low enough not to look like a flood to ExamTopics.
+DEFAULT_CONCURRENCY = 8
+
+# Timeout (seconds) for a single question page request
+REQUEST_TIMEOUT = 15
+
+# Jobs of the `serve` command whose crawl and detail stage run at the same time
+DEFAULT_MAX_JOBS = 4
+
+# Work queue of coordinate/work/merge: questions per shard, seconds a shard
+# lease lasts unless renewed, and leases of a shard before it is given up
+DEFAULT_SHARD_SIZE = 50
+DEFAULT_LEASE_SECONDS = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
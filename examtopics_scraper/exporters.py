@@ -1,8 +1,25 @@
 import csv
+import json
 import os
-from typing import List, Dict, Any
+import queue
+import tempfile
+import time
+from typing import List, Dict, Any, Iterator, Optional
 
 import itemadapter
+from scrapy import signals
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import threads
+
+from examtopics_scraper.cache import ResponseCache
+from examtopics_scraper.index import DiscussionIndex
+from examtopics_scraper.processing import OUTPUT_HEADER, build_output_row, parse_question_page, process_question_data
+from examtopics_scraper.records import QuestionColumns, QuestionRecord
+from examtopics_scraper.workqueue import DEFAULT_SHARD_SIZE, WorkQueue
+from examtopics_scraper.writers import RowWriter, open_writer
+
+# Default capacity of the hand-off queue between the spider and the detail stage
+HANDOFF_QUEUE_SIZE = 100
 
 
 class ScrapyPipeline:
@@ -35,8 +52,11 @@ class ExamtopicsQuestionsStdoutPipeline(ScrapyPipeline):
 class ExamtopicsQuestionsCsvPipeline(ScrapyPipeline):
     """CSV exporter for ExamTopics question discussions (id, url)."""
 
-    def __init__(self, output_file):
+    header = ['id', 'url']
+
+    def __init__(self, output_file, append=False):
         self.output_file = output_file
+        self.append = append
         self.file_handle = None
         self.csv_writer = None
 
@@ -49,13 +69,16 @@ class ExamtopicsQuestionsCsvPipeline(ScrapyPipeline):
         output_dir = os.path.dirname(output_file)
         if output_dir: # Only create if path includes a directory
             os.makedirs(output_dir, exist_ok=True)
-        return cls(output_file=output_file)
+        return cls(output_file=output_file, append=crawler.settings.getbool('CSV_OUTPUT_APPEND'))
 
     def open_spider(self, spider):
+        # Appending to a non-empty file keeps its header
+        append = self.append and os.path.exists(self.output_file) and os.path.getsize(self.output_file) > 0
         try:
-            self.file_handle = open(self.output_file, 'w', newline='', encoding='utf-8')
+            self.file_handle = open(self.output_file, 'a' if append else 'w', newline='', encoding='utf-8')
             self.csv_writer = csv.writer(self.file_handle)
-            self.csv_writer.writerow(['id', 'url'])  # Write header
+            if not append:
+                self.csv_writer.writerow(self.header)  # Write header
         except IOError as e:
             spider.logger.error(f"Failed to open CSV file {self.output_file}: {e}")
             self.file_handle = None # Ensure handle is None if open fails
@@ -80,31 +103,307 @@ class ExamtopicsQuestionsCsvPipeline(ScrapyPipeline):
              spider.logger.error(f"Failed to write row to CSV: {row} - {e}")
         return item
 
+
+class ExamtopicsQuestionDetailsCsvPipeline(ExamtopicsQuestionsCsvPipeline):
+    """
+    Exporter for ExamTopics question details fetched by the spider itself,
+    in the CSV_OUTPUT_FORMAT format (by default that of the file extension,
+    see writers.open_writer).
+
+    Items are QuestionPages: they carry the question page `body` and its
+    sequence number `seq` in listing order. Fields are extracted with XPATHS,
+    and rows are written in `seq` order: pages that complete early wait in a reorder buffer until every
+    earlier question has been written.
+
+    The spider cannot be held back like the requests-based stage, so the
+    buffer keeps at most `max_pending` rows (twice CONCURRENT_REQUESTS) in
+    memory. Rows beyond that, behind a slow head-of-line request, wait in a
+    temporary file, with only their offset kept.
+    """
+
+    header = OUTPUT_HEADER
+
+    def __init__(self, output_file, append=False, output_format=None):
+        super().__init__(output_file, append)
+        self.output_format = output_format
+        self.row_writer: Optional[RowWriter] = None
+        self.pending_rows: Dict[int, List[str]] = {}
+        self.max_pending = 16
+        self.spilled_rows: Dict[int, int] = {} # Offsets in spill_file of the pending rows beyond max_pending
+        self.spill_file = None
+        self.next_seq = 0
+        self.processed_count = 0
+        self.error_count = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.output_format = crawler.settings.get('CSV_OUTPUT_FORMAT')
+        pipeline.max_pending = crawler.settings.getint('CONCURRENT_REQUESTS') * 2
+        return pipeline
+
+    def open_spider(self, spider):
+        try:
+            self.row_writer = open_writer(self.output_file, self.header, append=self.append,
+                                          output_format=self.output_format)
+        except (IOError, ValueError) as e:
+            spider.logger.error(f"Failed to open output file {self.output_file}: {e}")
+            self.row_writer = None
+
+    def close_spider(self, spider):
+        # Questions whose request never completed leave gaps; write the rest in order
+        for seq in sorted([*self.pending_rows, *self.spilled_rows]):
+            self._write_row(self._pop_pending_row(seq), spider)
+        if self.spill_file:
+            self.spill_file.close()
+        if self.row_writer:
+            self.row_writer.close()
+        spider.logger.info(f"Question details written: {self.processed_count}, "
+                           f"with fetch/parse errors: {self.error_count}")
+        spider.crawler.stats.set_value('examtopics/details_written', self.processed_count)
+        spider.crawler.stats.set_value('examtopics/detail_errors', self.error_count)
+
+    def process_item(self, item, spider):
+        adapter = itemadapter.ItemAdapter(item)
+        extracted_data = {}
+        body = adapter.get('body')
+        if body:
+            start = time.perf_counter()
+            try:
+                extracted_data = parse_question_page(body)
+            except Exception as e:
+                spider.logger.error(f"Error parsing HTML (ID: {adapter.get('question')}): {adapter.get('url')} - {e}")
+                self.error_count += 1
+            spider.crawler.stats.inc_value('examtopics/detail_parse_seconds', time.perf_counter() - start)
+        else:
+            self.error_count += 1
+
+        extracted_data.update({'Question ID': adapter.get('question'), 'Topic': adapter.get('topic'),
+                               'URL': adapter.get('url')})
+        self._add_pending_row(adapter['seq'], build_output_row(extracted_data))
+        while self.next_seq in self.pending_rows or self.next_seq in self.spilled_rows:
+            self._write_row(self._pop_pending_row(self.next_seq), spider)
+            self.next_seq += 1
+        return item
+
+    def _add_pending_row(self, seq, row):
+        if seq == self.next_seq or len(self.pending_rows) < self.max_pending:
+            self.pending_rows[seq] = row
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spilled_rows[seq] = self.spill_file.tell()
+        self.spill_file.write(json.dumps(row).encode('utf-8') + b"\n")
+
+    def _pop_pending_row(self, seq):
+        if seq in self.pending_rows:
+            return self.pending_rows.pop(seq)
+        self.spill_file.seek(self.spilled_rows.pop(seq))
+        return json.loads(self.spill_file.readline())
+
+    def _write_row(self, row, spider):
+        if not self.row_writer:
+            spider.logger.warning("Output writer not available, skipping item.")
+            return
+        self.row_writer.write_row(row)
+        self.processed_count += 1
+
+
+class DiscussionIndexPipeline(ScrapyPipeline):
+    """
+    Records every discussion yielded by ExamtopicsDiscussionsSpider in the
+    DiscussionIndex at DISCUSSION_INDEX_PATH, in batches. They only replace
+    the provider's previous discussions, and mark it as indexed, if the crawl
+    finishes normally with no listing page failed.
+    """
+
+    batch_size = 500
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.index = None
+        self.batch: List[Dict[str, Any]] = []
+        self.item_count = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        index_path = crawler.settings.get('DISCUSSION_INDEX_PATH')
+        if not index_path:
+            raise ValueError("DISCUSSION_INDEX_PATH setting is required for DiscussionIndexPipeline")
+        pipeline = cls(index_path=index_path)
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.index = DiscussionIndex(self.index_path)
+        self.index.start_crawl(spider.provider)
+
+    def close_spider(self, spider):
+        self._flush(spider)
+
+    def spider_closed(self, spider, reason):
+        # Only a complete listing replaces the previous index of the provider
+        if reason == 'finished' and not spider.crawler.stats.get_value('examtopics/listing_pages_failed'):
+            self.index.finish_crawl(spider.provider)
+        spider.logger.info(f"Discussion index closed ({reason}). Indexed {self.item_count} discussions.")
+        self.index.close()
+
+    def process_item(self, item, spider):
+        self.batch.append(itemadapter.ItemAdapter(item).asdict())
+        self.item_count += 1
+        if len(self.batch) >= self.batch_size:
+            self._flush(spider)
+        return item
+
+    def _flush(self, spider):
+        if self.batch:
+            self.index.add_discussions(spider.provider, self.batch)
+            self.batch = []
+
+
+class WorkQueuePipeline(ScrapyPipeline):
+    """
+    Adds every question yielded by ExamtopicsQuestionsSpider to the WorkQueue
+    at WORK_QUEUE_PATH (shards of WORK_QUEUE_SHARD_SIZE questions), in
+    batches, so workers can claim full shards while the listing is still
+    being crawled. The queue is only sealed if the crawl finishes normally.
+    """
+
+    batch_size = 100
+
+    def __init__(self, queue_path, shard_size=DEFAULT_SHARD_SIZE):
+        self.queue_path = queue_path
+        self.shard_size = shard_size
+        self.work_queue = None
+        self.batch: List[QuestionRecord] = []
+        self.item_count = 0
+        self.added_count = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        queue_path = crawler.settings.get('WORK_QUEUE_PATH')
+        if not queue_path:
+            raise ValueError("WORK_QUEUE_PATH setting is required for WorkQueuePipeline")
+        pipeline = cls(queue_path, crawler.settings.getint('WORK_QUEUE_SHARD_SIZE', DEFAULT_SHARD_SIZE))
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.work_queue = WorkQueue(self.queue_path, self.shard_size)
+        self.work_queue.begin(spider.provider, spider.exam_code)
+
+    def close_spider(self, spider):
+        self._flush()
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            self.work_queue.seal()
+        spider.logger.info(f"Work queue closed ({reason}). Queued {self.added_count} new questions "
+                           f"of {self.item_count}.")
+        self.work_queue.close()
+
+    def process_item(self, item, spider):
+        self.batch.append(QuestionRecord.from_item(item))
+        self.item_count += 1
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+        return item
+
+    def _flush(self):
+        if self.batch:
+            self.added_count += self.work_queue.add(self.batch)
+            self.batch = []
+
+
 # --- New Pipeline ---
 class ItemCollectorPipeline:
     """
-    A Scrapy pipeline that collects all processed items into an in-memory list.
-    The collected items can be accessed via the `items` attribute after the
-    spider has finished running.
+    A Scrapy pipeline that collects all question records in memory, as
+    compact QuestionColumns. The collected items can be accessed via the
+    `items` attribute after the spider has finished running.
     """
     def __init__(self):
-        self.items: List[Dict[str, Any]] = []
+        self.items = QuestionColumns()
 
     def open_spider(self, spider):
-        self.items = [] # Ensure list is clear for each run
+        self.items = QuestionColumns() # Ensure the columns are clear for each run
         spider.logger.info("ItemCollectorPipeline opened.")
 
     def close_spider(self, spider):
         spider.logger.info(f"ItemCollectorPipeline closed. Collected {len(self.items)} items.")
 
     def process_item(self, item, spider):
-        adapter = itemadapter.ItemAdapter(item)
-        # Adapt the item to a dictionary and append.
-        # Ensure 'question' is used as 'id' for consistency with CSV pipeline logic
-        item_dict = adapter.asdict()
-        item_id = item_dict.get('question', f"ID_MISSING_{item_dict.get('url', 'NO_URL')}")
-        processed_item = {'id': item_id, 'url': item_dict.get('url')}
-        self.items.append(processed_item)
+        self.items.append(QuestionRecord.from_item(item))
         return item # Return item for potential further processing by other pipelines
 
+
+class ItemQueuePipeline:
+    """
+    A Scrapy pipeline that hands each item, as a QuestionRecord, to a
+    consumer thread through a bounded queue as soon as the spider yields it.
+
+    The queue is passed to the spider as the `item_queue` argument. When the
+    queue is full, the put happens in a reactor worker thread and the item is
+    only released once there is room, so Scrapy's own item backpressure slows
+    the crawl down instead of buffering every item in memory. Whoever owns the
+    queue is responsible for putting the `None` end-of-stream marker.
+    """
+    def __init__(self):
+        self.item_queue: Optional[queue.Queue] = None
+        self.item_count = 0
+
+    def open_spider(self, spider):
+        self.item_queue = getattr(spider, 'item_queue', None)
+        if self.item_queue is None:
+            raise ValueError("The spider needs an 'item_queue' argument for ItemQueuePipeline")
+        self.item_count = 0
+        spider.logger.info("ItemQueuePipeline opened.")
+
+    def close_spider(self, spider):
+        spider.logger.info(f"ItemQueuePipeline closed. Handed off {self.item_count} items.")
+
+    async def process_item(self, item, spider):
+        record = QuestionRecord.from_item(item)
+        self.item_count += 1
+        try:
+            self.item_queue.put_nowait(record)
+        except queue.Full:
+            # Wait for the consumer off the reactor thread
+            await maybe_deferred_to_future(threads.deferToThread(self.item_queue.put, record))
+        return item
+
+
+def iterate_queue(item_queue: queue.Queue) -> Iterator[QuestionRecord]:
+    """Yields items from `item_queue` until the `None` end-of-stream marker."""
+    while (item := item_queue.get()) is not None:
+        yield item
+
+
+def run_detail_stage(item_queue: queue.Queue, output_path: str, detail_options: Dict[str, Any],
+                     cache: Optional[ResponseCache] = None, append: bool = False) -> int:
+    """
+    Runs process_question_data over the items of `item_queue` (filled by
+    ItemQueuePipeline) until the end-of-stream marker, passing it
+    `detail_options`. Returns the number of items consumed.
+
+    If the detail stage fails, the queue is still drained so the spider never
+    blocks on a full queue, and the error is raised once the stream ends.
+    """
+    item_count = 0
+
+    def counted_items():
+        nonlocal item_count
+        for item in iterate_queue(item_queue):
+            item_count += 1
+            yield item
+
+    try:
+        process_question_data(counted_items(), output_path, cache=cache, append=append, **detail_options)
+    except Exception:
+        for _ in iterate_queue(item_queue):
+            pass
+        raise
+    return item_count
+
 # Removed generate_questions_html_exporter and ExamtopicsQuestionsHtmlPipeline
@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator
+
+from lxml import etree, html
+
+# Container of the question text, answer choices and revealed answer
+QUESTION_BODY_XPATH = '/html/body/div[2]/div/div[4]/div/div[1]/div[2]'
+
+# Fields relative to the question body
+QUESTION_FIELD_XPATHS = {
+    'Question': 'p/text()',
+    'Correct Answer': 'div[3]/span[1]/span/text()',
+}
+# One element per answer choice, whatever their number
+ANSWER_CHOICES_XPATH = 'div[2]/ul/li'
+
+# Compiled once per process instead of once per page and field
+_QUESTION_BODY = etree.XPath(QUESTION_BODY_XPATH)
+_QUESTION_FIELDS = {key: etree.XPath(xpath) for key, xpath in QUESTION_FIELD_XPATHS.items()}
+_ANSWER_CHOICES = etree.XPath(ANSWER_CHOICES_XPATH)
+_TEXT = etree.XPath('text()')
+
+# Pages handed to each process pool worker at once
+POOL_CHUNK_SIZE = 16
+
+
+def extract_question(content: bytes) -> Dict[str, str]:
+    """
+    Extracts the question fields of a question page in a single pass over
+    the question body: 'Question', 'Correct Answer' and 'Answer 1' to
+    'Answer N' for the N answer choices of the page.
+
+    Fields missing from the page are empty strings.
+
+    Raises:
+        Exception: Whatever lxml raises if the page cannot be parsed.
+    """
+    fields = dict.fromkeys(QUESTION_FIELD_XPATHS, "")
+    bodies = _QUESTION_BODY(html.fromstring(content))
+    if not bodies:
+        return fields
+    body = bodies[0]
+    for key, xpath in _QUESTION_FIELDS.items():
+        # Join potentially fragmented text nodes and strip whitespace
+        fields[key] = "".join(xpath(body)).strip()
+    for number, choice in enumerate(_ANSWER_CHOICES(body), start=1):
+        fields[f'Answer {number}'] = "".join(_TEXT(choice)).strip()
+    return fields
+
+
+def extract_questions(pages: Iterable[bytes], workers: int = 0) -> Iterator[Dict[str, str]]:
+    """
+    Extracts many question pages, in order. With `workers` > 0, parsing is
+    spread over that many processes, e.g. to reprocess a large cached corpus.
+    """
+    if workers <= 0:
+        yield from map(extract_question, pages)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(extract_question, pages, chunksize=POOL_CHUNK_SIZE)
@@ -0,0 +1,215 @@
+import hashlib
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Routes of the stand-in site, mirroring the ExamTopics URLs the spiders use
+EXAMS_ROUTE = re.compile(r"^/exams/(?P<provider>[^/]+)/$")
+LISTING_ROUTE = re.compile(r"^/discussions/(?P<provider>[^/]+)/(?:(?P<page>\d+)/)?$")
+QUESTION_ROUTE = re.compile(r"^/discussions/(?P<provider>[^/]+)/view/(?P<discussion>\d+)-[^/]*/$")
+
+ANSWER_LETTERS = "ABCDEF"
+
+
+@dataclass
+class FakeSiteConfig:
+    """Shape and behaviour of the synthetic site served by FakeSite."""
+    exams: int = 5 # Exams per provider, with codes EX-0, EX-1, ...
+    listing_pages: int = 50
+    discussions_per_page: int = 20
+    latency: float = 0.0 # Seconds added to every response
+    latency_jitter: float = 0.0 # Up to this many extra seconds, uniformly random
+    error_rate: float = 0.0 # Share of responses replaced by 500 errors
+    rate_limit_rate: float = 0.0 # Share of responses replaced by 429 errors
+    retry_after: int = 1 # Retry-After header of 429 responses (seconds)
+    page_size: int = 50_000 # Approximate size of question pages in bytes
+    seed: int = 0
+    revision: int = 0 # Bumping it changes every 10th question of each exam, e.g. to exercise a refresh
+
+    @property
+    def discussion_count(self) -> int:
+        return self.listing_pages * self.discussions_per_page
+
+
+class FakeSiteStats:
+    """Requests served by FakeSite, by page kind, with their handling times."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[str, List[tuple]] = {"exams": [], "listing": [], "question": [], "other": []}
+        self.statuses: Dict[int, int] = {}
+
+    def record(self, kind: str, status: int, start: float, end: float, size: int):
+        with self._lock:
+            self.requests[kind].append((start, end, size))
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def snapshot(self) -> Dict[str, List[tuple]]:
+        with self._lock:
+            return {kind: list(requests) for kind, requests in self.requests.items()}
+
+    def reset(self):
+        with self._lock:
+            for requests in self.requests.values():
+                requests.clear()
+            self.statuses.clear()
+
+
+def exam_code(exam: int) -> str:
+    return f"EX-{exam}"
+
+
+def render_exams(config: FakeSiteConfig, provider: str) -> str:
+    links = "".join(
+        f'<a class="popular-exam-link" href="/exams/{provider}/{exam_code(exam).lower()}/">'
+        f'<span class="popular-exam-code">{exam_code(exam)}</span>Synthetic exam {exam}</a>\n'
+        for exam in range(config.exams))
+    return f"<html><body><div>{links}</div></body></html>"
+
+
+def discussion_slug(config: FakeSiteConfig, discussion: int):
+    """Exam code, topic and question number of a discussion (newest first)."""
+    exam = discussion % config.exams
+    question = (config.discussion_count - 1 - discussion) // config.exams + 1
+    return exam_code(exam), 1 + question // 100, question
+
+
+def discussion_link(config: FakeSiteConfig, provider: str, discussion: int) -> Tuple[str, str]:
+    """Path and link text of a discussion in the listing."""
+    code, topic, question = discussion_slug(config, discussion)
+    path = (f"/discussions/{provider}/view/{discussion}-exam-{code.lower()}-topic-{topic}"
+            f"-question-{question}-discussion/")
+    return path, f"\n    Exam {code} topic {topic} question {question} discussion\n"
+
+
+def render_listing(config: FakeSiteConfig, provider: str, page: int) -> str:
+    first = (page - 1) * config.discussions_per_page
+    links = []
+    for discussion in range(first, first + config.discussions_per_page):
+        path, title = discussion_link(config, provider, discussion)
+        links.append(f'<a class="discussion-link" href="{path}">{title}</a>\n')
+    next_link = (f'<a class="btn btn-sm" href="/discussions/{provider}/{page + 1}/">Next Page</a>'
+                 if page < config.listing_pages else "")
+    return (f"<html><body><div>{''.join(links)}</div>"
+            f'<span class="pagination-nav">{next_link}</span>'
+            f'<span class="discussion-list-page-indicator">Page <strong>{page}</strong> of '
+            f'<strong>{config.listing_pages}</strong></span></body></html>')
+
+
+def render_question(config: FakeSiteConfig, discussion: int) -> str:
+    # Same structure as the real pages, as far as XPATHS is concerned
+    code, topic, question = discussion_slug(config, discussion)
+    revised = config.revision if question % 10 == 0 else 0
+    rng = random.Random(config.seed * 1_000_003 + discussion + revised * 7919)
+    choices = rng.randint(3, 6)
+    answer = "".join(sorted(rng.sample(ANSWER_LETTERS[:choices], rng.choice((1, 1, 1, 2)))))
+    items = "".join(f'<li><span class="multi-choice-letter">{ANSWER_LETTERS[n]}.</span> '
+                    f"Choice {ANSWER_LETTERS[n]} of question {question}</li>" for n in range(choices))
+    revision_note = f" (revision {revised})" if revised else ""
+    question_body = (f"<div><p>{code} topic {topic} question {question}{revision_note}: which option is correct?</p>"
+                     f"<div></div><div><ul>{items}</ul></div>"
+                     f"<div><span><span>{answer}</span></span></div></div>")
+    comment = "<div class='comment'>Synthetic discussion comment. </div>\n"
+    padding = comment * max(0, (config.page_size - len(question_body)) // len(comment))
+    return ("<html><body><div>Header</div><div><div><div></div><div></div><div></div>"
+            f"<div><div><div><div></div>{question_body}</div></div></div></div></div>"
+            f"<div>{padding}</div></body></html>")
+
+
+class FakeSite:
+    """
+    Local stand-in for ExamTopics, serving synthetic exam lists, paginated
+    discussion listings and question pages in the markup the spiders and
+    XPATHS expect, with configurable latency and error/429 rates. Question
+    pages carry an ETag and answer a matching If-None-Match with 304.
+    """
+
+    def __init__(self, config: Optional[FakeSiteConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeSiteConfig()
+        self.stats = FakeSiteStats()
+        self._rng = random.Random(self.config.seed)
+        self._rng_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        """Serves in a background thread and returns the site's base URL."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-site", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _random(self) -> float:
+        with self._rng_lock:
+            return self._rng.random()
+
+    def _route(self, path: str):
+        """Returns (kind, status, body) for `path`."""
+        config = self.config
+        if match := EXAMS_ROUTE.match(path):
+            return "exams", 200, render_exams(config, match["provider"])
+        if match := LISTING_ROUTE.match(path):
+            page = int(match["page"] or 1)
+            if 1 <= page <= config.listing_pages:
+                return "listing", 200, render_listing(config, match["provider"], page)
+            return "listing", 404, "<html><body>Not found</body></html>"
+        if match := QUESTION_ROUTE.match(path):
+            discussion = int(match["discussion"])
+            if discussion < config.discussion_count:
+                return "question", 200, render_question(config, discussion)
+            return "question", 404, "<html><body>Not found</body></html>"
+        return "other", 404, "<html><body>Not found</body></html>"
+
+    def _handler_class(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like the real site
+
+            def do_GET(self):
+                start = time.perf_counter()
+                config = site.config
+                kind, status, body = site._route(self.path.split("?", 1)[0])
+                headers = {"Content-Type": "text/html; charset=utf-8"}
+                if status == 200:
+                    if site._random() < config.rate_limit_rate:
+                        status, body = 429, "<html><body>Too Many Requests</body></html>"
+                        headers["Retry-After"] = str(config.retry_after)
+                    elif site._random() < config.error_rate:
+                        status, body = 500, "<html><body>Internal Server Error</body></html>"
+                if status == 200 and kind == "question":
+                    headers["ETag"] = '"%s"' % hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+                    if self.headers.get("If-None-Match") == headers["ETag"]:
+                        status, body = 304, ""
+                delay = config.latency + config.latency_jitter * site._random()
+                if delay:
+                    time.sleep(delay)
+                payload = body.encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                site.stats.record(kind, status, start, time.perf_counter(), len(payload))
+
+            def log_message(self, format, *args):
+                pass # Keep benchmark output readable
+
+        return Handler
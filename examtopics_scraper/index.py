@@ -0,0 +1,111 @@
+import heapq
+import re
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from examtopics_scraper.records import QuestionColumns, QuestionRecord, intern_text
+from examtopics_scraper.spiders import exam_question_regex
+
+# Best-effort split of a discussion title into exam code, topic and question
+# number. Exam codes may contain spaces, so resolving an exam always re-applies
+# the exact exam_question_regex used by ExamtopicsQuestionsSpider.
+DISCUSSION_TITLE_REGEX = re.compile(r"^\s*Exam (.+?) (topic \d+) question (\d+)", re.IGNORECASE)
+
+
+class DiscussionIndex:
+    """
+    Persistent per-provider index of discussion links, stored in SQLite.
+
+    One crawl of a provider's discussion listing (ExamtopicsDiscussionsSpider)
+    records every link with its title, page and rank. The question list of
+    any exam of that provider can then be resolved without crawling again.
+
+    A crawl writes to a staging table, which only replaces the provider's
+    discussions once the crawl finishes: an interrupted rebuild leaves the
+    previous index in place.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS discussions (
+                provider TEXT NOT NULL,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                exam TEXT,
+                topic TEXT,
+                question INTEGER,
+                page INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                PRIMARY KEY (provider, url)
+            );
+            -- Serves resolve in listing order, without a scan or a sort
+            CREATE INDEX IF NOT EXISTS discussions_exam_order
+                ON discussions (provider, exam COLLATE NOCASE, page, rank);
+            CREATE TABLE IF NOT EXISTS staged_discussions AS SELECT * FROM discussions WHERE 0;
+            CREATE TABLE IF NOT EXISTS crawls (
+                provider TEXT PRIMARY KEY,
+                completed_at REAL
+            );
+        """)
+        self._conn.commit()
+
+    def start_crawl(self, provider: str):
+        """Starts a new crawl of `provider`, dropping what an interrupted one staged."""
+        with self._conn:
+            self._conn.execute("DELETE FROM staged_discussions WHERE provider = ?", (provider,))
+
+    def add_discussions(self, provider: str, discussions: Iterable[Dict[str, Any]]):
+        """Stages discussion items (title, url, page, rank) of the current crawl of `provider`."""
+        rows = []
+        for discussion in discussions:
+            title = discussion.get('title') or ""
+            match = DISCUSSION_TITLE_REGEX.search(title)
+            rows.append((provider, discussion['url'], title,
+                         match.group(1) if match else None,
+                         match.group(2) if match else None,
+                         int(match.group(3)) if match else None,
+                         discussion['page'], discussion['rank']))
+        with self._conn:
+            self._conn.executemany("INSERT INTO staged_discussions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def finish_crawl(self, provider: str):
+        """Replaces the discussions of `provider` with the staged ones and marks the crawl as complete."""
+        with self._conn:
+            self._conn.execute("DELETE FROM discussions WHERE provider = ?", (provider,))
+            # A URL listed twice (the listing moved during the crawl) keeps its last position
+            self._conn.execute("INSERT OR REPLACE INTO discussions SELECT * FROM staged_discussions "
+                               "WHERE provider = ? ORDER BY rowid", (provider,))
+            self._conn.execute("DELETE FROM staged_discussions WHERE provider = ?", (provider,))
+            self._conn.execute("INSERT OR REPLACE INTO crawls VALUES (?, ?)", (provider, time.time()))
+
+    def completed_at(self, provider: str) -> Optional[float]:
+        """Returns when `provider` was last fully indexed, or None."""
+        row = self._conn.execute("SELECT completed_at FROM crawls WHERE provider = ?", (provider,)).fetchone()
+        return row[0] if row else None
+
+    def resolve(self, provider: str, exam_code: str) -> QuestionColumns:
+        """
+        Returns the question records of `exam_code` in listing order, exactly
+        as ExamtopicsQuestionsSpider would have yielded them.
+        """
+        question_regex = exam_question_regex(exam_code)
+        # Both come in listing order from discussions_exam_order; titles whose
+        # exam could not be split off are matched in Python only
+        exam_rows = self._conn.execute(
+            "SELECT page, rank, title, url FROM discussions WHERE provider = ? AND exam = ? COLLATE NOCASE "
+            "ORDER BY page, rank", (provider, exam_code))
+        unsplit_rows = self._conn.execute(
+            "SELECT page, rank, title, url FROM discussions WHERE provider = ? AND exam IS NULL "
+            "ORDER BY page, rank", (provider,))
+        questions = QuestionColumns()
+        for _, _, title, url in heapq.merge(exam_rows, unsplit_rows):
+            if match := question_regex.search(title):
+                questions.append(QuestionRecord(int(match.group(2)), intern_text(match.group(1)), url))
+        return questions
+
+    def close(self):
+        self._conn.close()
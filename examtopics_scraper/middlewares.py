@@ -0,0 +1,48 @@
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+
+from examtopics_scraper.cache import ResponseCache, cache_from_settings
+
+
+class ResponseCacheMiddleware:
+    """
+    Downloader middleware serving pages from a ResponseCache.
+
+    Enabled by the RESPONSE_CACHE_PATH setting. Cache hits are returned
+    without touching the network; successful downloads are stored. With
+    RESPONSE_CACHE_OFFLINE, cache misses are ignored instead of downloaded.
+
+    It must run before HttpCompressionMiddleware (order below 590): bodies
+    are stored decoded and replayed without their headers.
+    """
+
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        cache = cache_from_settings(crawler.settings)
+        if cache is None:
+            raise NotConfigured
+        middleware = cls(cache)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        self.cache.close()
+
+    def process_request(self, request, spider):
+        body = self.cache.get(request.url)
+        if body is not None:
+            spider.crawler.stats.inc_value('response_cache/hit')
+            return HtmlResponse(request.url, body=body, request=request, flags=['cached'])
+        spider.crawler.stats.inc_value('response_cache/miss')
+        if self.cache.offline:
+            raise IgnoreRequest(f"Offline mode: {request.url} is not in the cache")
+        return None
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 and 'cached' not in response.flags:
+            self.cache.set(request.url, response.body)
+        return response
@@ -1,11 +1,30 @@
-import csv
+import os
 import sys
 import requests
 import random
-from lxml import html
-from typing import List, Dict, Any
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import TYPE_CHECKING, List, Dict, Any, Iterable, Optional, Sized, Tuple
 
-# Define XPaths for data extraction (copied from process_data.py)
+from examtopics_scraper.cache import ResponseCache
+from examtopics_scraper.checkpoint import ScrapeJournal
+from examtopics_scraper.defaults import DEFAULT_CONCURRENCY, REQUEST_TIMEOUT
+from examtopics_scraper.extraction import extract_question
+from examtopics_scraper.records import QuestionRecord
+from examtopics_scraper.stats import RunStats
+from examtopics_scraper.throttle import (DEFAULT_MAX_RETRIES, RETRY_STATUSES, THROTTLE_STATUSES, AdaptiveLimiter,
+                                         backoff_delay, parse_retry_after)
+from examtopics_scraper.writers import open_writer
+
+if TYPE_CHECKING:
+    from examtopics_scraper.refresh import DatasetRefresh
+
+# Define XPaths for data extraction (copied from process_data.py).
+# extraction.py evaluates the same paths, compiled once and relative to the
+# question body; these absolute ones are kept for extract_data.
 XPATHS = {
     'Question': '/html/body/div[2]/div/div[4]/div/div[1]/div[2]/p/text()',
     'Correct Answer': '/html/body/div[2]/div/div[4]/div/div[1]/div[2]/div[3]/span[1]/span/text()',
@@ -16,8 +35,10 @@ XPATHS = {
     'Answer 5': '/html/body/div[2]/div/div[4]/div/div[1]/div[2]/div[2]/ul/li[5]/text()', # Optional
 }
 
-# Define the header for the output CSV (copied from process_data.py)
-OUTPUT_HEADER = ['Question', 'Correct Answer', 'Answer 1', 'Answer 2', 'Answer 3', 'Answer 4', 'Answer 5']
+# Define the header for the output CSV (copied from process_data.py), followed by
+# the question id, topic and URL so that downstream jobs need not re-join them
+OUTPUT_HEADER = ['Question', 'Correct Answer', 'Answer 1', 'Answer 2', 'Answer 3', 'Answer 4', 'Answer 5',
+                 'Question ID', 'Topic', 'URL']
 
 # Define a list of User-Agent strings (copied from process_data.py)
 USER_AGENTS = [
@@ -49,127 +70,404 @@ def extract_data(tree, xpath: str) -> str:
         return "" # Return empty string on error
 
 
-def process_question_data(scraped_items: List[Dict[str, Any]], output_csv_path: str):
+def create_session(pool_size: int = DEFAULT_CONCURRENCY) -> requests.Session:
+    """
+    Creates a requests session whose connection pool can hold one keep-alive
+    connection per concurrent worker, so TCP/TLS handshakes are reused across
+    questions instead of being repeated for every page.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class SessionPool:
+    """
+    Idle keep-alive sessions shared by successive detail stages (e.g. the
+    jobs of a long-running `serve` process), so their connections outlive a
+    single scrape. A session is used by one fetch thread at a time.
+    """
+
+    def __init__(self):
+        self._idle: List[requests.Session] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> requests.Session:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return create_session(pool_size=1)
+
+    def release(self, session: requests.Session):
+        with self._lock:
+            self._idle.append(session)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
+def download(session: requests.Session, url: str, limiter: Optional[AdaptiveLimiter] = None,
+             max_retries: int = DEFAULT_MAX_RETRIES, stats: Optional[RunStats] = None,
+             headers: Optional[Dict[str, str]] = None) -> requests.Response:
+    """
+    Downloads a question page with the extra request `headers`, retrying up
+    to `max_retries` times on timeouts, connection errors and RETRY_STATUSES
+    responses. Returns the response (possibly a 304 to a conditional request).
+
+    With a `limiter`, each attempt waits for a concurrency slot and reports
+    its outcome; 429/503 responses then pause every request for their
+    Retry-After delay. Without one, the retry itself waits that long.
+    Attempts are counted and timed in `stats`.
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt failed.
+    """
+    stats = stats if stats is not None else RunStats()
+    for attempt in range(max_retries + 1):
+        if attempt:
+            stats.inc('detail/retries')
+            if limiter:
+                limiter.record_retry()
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            random_user_agent = random.choice(USER_AGENTS)
+            request_headers = dict(headers or {}, **{'User-Agent': random_user_agent})
+            response = session.get(url, headers=request_headers, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            stats.inc(f'detail/request_errors/{type(e).__name__}')
+            if limiter:
+                limiter.release(failed=True)
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_delay(attempt + 1))
+            continue
+        except BaseException:
+            if limiter:
+                limiter.release(failed=True)
+            raise
+
+        latency = time.monotonic() - start
+        status = response.status_code
+        stats.observe('detail/fetch_seconds', latency)
+        stats.inc(f'detail/responses/{status}')
+        throttled = status in THROTTLE_STATUSES
+        retry_after = parse_retry_after(response.headers.get('Retry-After')) if throttled else None
+        if limiter:
+            limiter.release(latency, throttled=throttled, retry_after=retry_after,
+                            failed=status >= 500 and not throttled)
+        if status not in RETRY_STATUSES or attempt == max_retries:
+            response.raise_for_status() # Check for HTTP errors (4xx, 5xx)
+            stats.inc('detail/bytes_downloaded', len(response.content))
+            return response
+        if not (limiter and throttled): # The limiter already pauses throttled requests
+            time.sleep(retry_after if retry_after is not None else backoff_delay(attempt + 1))
+
+
+def fetch_and_extract(session: requests.Session, item_num: int, record: QuestionRecord,
+                      cache: Optional[ResponseCache] = None,
+                      parser: Optional[ProcessPoolExecutor] = None,
+                      limiter: Optional[AdaptiveLimiter] = None,
+                      max_retries: int = DEFAULT_MAX_RETRIES,
+                      stats: Optional[RunStats] = None,
+                      refresh: Optional['DatasetRefresh'] = None) -> Tuple[Optional[List[str]], int]:
+    """
+    Fetches the page of a single question `record` and extracts its data.
+
+    If a `cache` is given, the page is served from it when possible and stored
+    in it after a successful download; in offline mode it is never downloaded.
+    If a `parser` process pool is given, the page is parsed in it instead of
+    in the calling thread. Downloads are retried and paced by `limiter` as
+    described in `download`. Cache hits and parse times are recorded in `stats`.
+    With a `refresh`, the page is requested conditionally, bypassing the
+    cache unless offline, and a 304 Not Modified answer returns the previous
+    row of the question.
+
+    Returns:
+        A tuple ``(output_row, error_count)``. ``output_row`` is ordered as
+        OUTPUT_HEADER, or None if the item has no URL and must be skipped.
+        Fetch/parse failures still produce a row with empty fields.
+    """
+    input_id = record.question
+    input_url = record.url
+    error_count = 0
+
+    if not input_url:
+        print(f"Skipping item {item_num} due to missing URL.", file=sys.stderr)
+        return None, 1
+
+    # Fields not extracted from the page are left empty by build_output_row
+    extracted_data: Dict[str, Any] = {'Question ID': input_id, 'Topic': record.topic, 'URL': input_url}
+    fetch_successful = False
+    stats = stats if stats is not None else RunStats()
+    # A refresh revalidates every page with the site: the cache is only written to,
+    # unless nothing can be downloaded anyway
+    read_cache = cache is not None and (refresh is None or cache.offline)
+    content = cache.get(input_url) if read_cache else None
+    if read_cache:
+        stats.inc('detail/cache_hits' if content is not None else 'detail/cache_misses')
+
+    # --- Fetch ---
+    if content is not None:
+        fetch_successful = True
+    elif cache and cache.offline:
+        print(f"Not in cache, skipped in offline mode (Item {item_num}, ID: {input_id}): {input_url}", file=sys.stderr)
+        error_count += 1
+    else:
+        try:
+            response = download(session, input_url, limiter=limiter, max_retries=max_retries, stats=stats,
+                                headers=refresh.conditional_headers(input_url) if refresh else None)
+            if response.status_code == 304 and refresh and refresh.previous_row(input_url):
+                stats.inc('detail/not_modified')
+                return refresh.previous_row(input_url), 0
+            content = response.content
+            fetch_successful = True
+            if refresh:
+                refresh.store_validators(input_url, response.headers)
+            if cache and content:
+                cache.set(input_url, content)
+        except requests.exceptions.Timeout:
+            print(f"Timeout fetching URL (Item {item_num}, ID: {input_id}): {input_url}", file=sys.stderr)
+            error_count += 1
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching URL (Item {item_num}, ID: {input_id}): {input_url} - {e}", file=sys.stderr)
+            error_count += 1
+
+    # --- Parse & Extract ---
+    if fetch_successful:
+        try:
+            # Ensure response content is not None before parsing
+            if content:
+                with stats.timer('detail/parse'):
+                    if parser:
+                        extracted_data.update(parser.submit(parse_question_page, content).result())
+                    else:
+                        extracted_data.update(parse_question_page(content))
+            else:
+                 print(f"Empty content received (Item {item_num}, ID: {input_id}): {input_url}", file=sys.stderr)
+                 error_count += 1
+
+        except Exception as e:
+            # Catch potential parsing errors from lxml
+            print(f"Error parsing HTML (Item {item_num}, ID: {input_id}): {input_url} - {e}", file=sys.stderr)
+            error_count += 1
+
+    return build_output_row(extracted_data), error_count
+
+
+def parse_question_page(content: bytes) -> Dict[str, str]:
+    """
+    Parses a question page and extracts the question, the revealed answer and
+    every answer choice (see extraction.extract_question).
+
+    Raises:
+        Exception: Whatever lxml raises if the page cannot be parsed.
+    """
+    return extract_question(content)
+
+
+def build_output_row(extracted_data: Dict[str, Any]) -> List[str]:
+    """
+    Maps the extracted correct answer letters to answer texts and returns the
+    row ordered as OUTPUT_HEADER. Missing fields become empty strings; answer
+    choices beyond 'Answer 5' count for the correct answer but have no column.
+    """
+    # --- Process Correct Answer (Adapted from process_data.py) ---
+    correct_answer_key = (extracted_data.get('Correct Answer') or '').strip().upper() # Normalize key
+
+    # Create a mapping from answer key ('A', 'B', ...) to the extracted answer text,
+    # for as many answer choices as the page has
+    answer_map = {}
+    while (answer_text := extracted_data.get(f'Answer {len(answer_map) + 1}')) is not None:
+        answer_map[chr(ord('A') + len(answer_map))] = answer_text
+
+    # Build the final correct answer string dynamically
+    result_answers = []
+    for char_key in correct_answer_key:
+        # Get the answer corresponding to the character key from the map
+        answer_text = answer_map.get(char_key)
+        # Append the answer text if the key was valid (A, B, ...) and text was found
+        if answer_text is not None:
+             # Only append non-empty answers to avoid extra newlines for missing optional answers
+             if answer_text:
+                result_answers.append(answer_text)
+
+    # Join the collected answers with newline characters
+    # If correct_answer_key was invalid or all corresponding answers were empty, this will be empty.
+    row_data = dict(extracted_data, **{'Correct Answer': "; ".join(result_answers)})
+
+    # Ensure the order matches OUTPUT_HEADER
+    return [str(row_data.get(col) or "") for col in OUTPUT_HEADER]
+
+
+def process_question_data(scraped_items: Iterable[QuestionRecord], output_path: str,
+                          concurrency: int = DEFAULT_CONCURRENCY, cache: Optional[ResponseCache] = None,
+                          append: bool = False, parse_workers: int = 0,
+                          journal: Optional[ScrapeJournal] = None, max_retries: int = DEFAULT_MAX_RETRIES,
+                          stats: Optional[RunStats] = None, output_format: Optional[str] = None,
+                          refresh: Optional['DatasetRefresh'] = None,
+                          session_pool: Optional[SessionPool] = None):
     """
     Fetches detailed question data based on scraped URLs, processes it,
-    and writes the results to a CSV file.
+    and writes the results to a CSV, JSON Lines or Parquet file.
+
+    Question pages are fetched by a pool of ``concurrency`` worker threads,
+    each with its own keep-alive session. An AdaptiveLimiter keeps the number
+    of requests in flight between 1 and ``concurrency``: it ramps up while
+    the site answers quickly and backs off on 429/503 responses. Rows are
+    still written in the order of ``scraped_items``: completed fetches wait
+    in a small reorder window until all earlier items have been written.
 
     Args:
-        scraped_items: A list of dictionaries, where each dictionary
-                       contains at least 'id' and 'url' keys from the
-                       initial scraping phase.
-        output_csv_path: The path to the CSV file where the processed
-                         data will be written.
+        scraped_items: An iterable of QuestionRecords from the initial
+                       scraping phase. Only the items still pending are
+                       referenced, so a generator (e.g. QuestionColumns.drain)
+                       keeps memory flat however many questions there are.
+        output_path: The path to the file where the processed data will be
+                     written.
+        output_format: 'csv', 'jsonl' or 'parquet'; inferred from the
+                       extension of ``output_path`` by default.
+        concurrency: Maximum number of question pages fetched at once.
+        max_retries: Attempts of a failed or throttled question page after the
+                     first one, before its row is written with empty fields.
+        cache: Optional response cache shared with the spiders.
+        append: Append rows to an existing, non-empty output file instead of
+                overwriting it (the header is then not written again).
+        parse_workers: If > 0, parse pages in that many processes instead of in
+                       the fetch threads (useful when replaying a large cache).
+        stats: Optional RunStats receiving the counters and timings of the
+               detail stage.
+        refresh: Optional DatasetRefresh of a previous output: pages are
+                 requested conditionally, every row is classified against
+                 it, and questions that fail keep their previous row.
+        journal: Optional journal of completed rows. Questions it already
+                 holds are not fetched again, and the output is rewritten from
+                 where the journaled scrape started; the caller finishes it.
+        session_pool: Optional SessionPool the fetch threads take their
+                      sessions from and return them to, instead of opening
+                      and closing their own.
     """
-    print(f"Processing {len(scraped_items)} scraped items...")
-    print(f"Writing output CSV to: {output_csv_path}")
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+
+    if isinstance(scraped_items, Sized):
+        print(f"Processing {len(scraped_items)} scraped items...")
+    print(f"Writing output to: {output_path} (concurrency: {concurrency})")
 
     processed_count = 0
+    resumed_count = 0
     error_count = 0
+    # Bound the number of submitted-but-unwritten items so a slow head-of-line
+    # request cannot make the reorder window grow without limit.
+    max_pending = concurrency * 2
+    parser = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 0 else None
+    limiter = AdaptiveLimiter(max_concurrency=concurrency)
+    stats = stats if stats is not None else RunStats()
+    start_time = time.perf_counter()
+    thread_local = threading.local()
+    sessions: List[requests.Session] = []
+    sessions_lock = threading.Lock()
+
+    def worker(item_num: int, item: QuestionRecord) -> Tuple[Optional[List[str]], int]:
+        # One session per worker thread: requests.Session is not guaranteed to be
+        # thread-safe, and each thread keeps its own keep-alive connection.
+        session = getattr(thread_local, 'session', None)
+        if session is None:
+            session = thread_local.session = session_pool.acquire() if session_pool else create_session(pool_size=1)
+            with sessions_lock:
+                sessions.append(session)
+        with stats.timer('detail/fetch_and_extract'):
+            return fetch_and_extract(session, item_num, item, cache=cache, parser=parser, limiter=limiter,
+                                     max_retries=max_retries, stats=stats, refresh=refresh)
+
+    append = append and os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    if journal is not None:
+        if journal.output_offset is None:
+            journal.begin(os.path.getsize(output_path) if append else 0)
+        elif os.path.exists(output_path) and os.path.getsize(output_path) > journal.output_offset:
+            # Drop the rows of the interrupted run, they are rewritten in order
+            with open(output_path, 'r+b') as outfile:
+                outfile.truncate(journal.output_offset)
+        append = journal.output_offset > 0 and os.path.exists(output_path)
 
     try:
-        with open(output_csv_path, 'w', newline='', encoding='utf-8') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(OUTPUT_HEADER) # Write header
+        with open_writer(output_path, OUTPUT_HEADER, append=append, output_format=output_format) as writer, \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetch') as executor:
 
-            for item_num, item in enumerate(scraped_items, start=1):
-                input_id = item.get('id', 'N/A') # Get id if available
-                input_url = item.get('url')
-
-                if not input_url:
-                    print(f"Skipping item {item_num} due to missing URL.", file=sys.stderr)
-                    error_count += 1
-                    continue
-
-                extracted_data: Dict[str, Any] = {'id': input_id, 'url': input_url} # Keep original id/url if needed later
-                fetch_successful = False
-
-                # Initialize data fields to empty strings based on OUTPUT_HEADER
-                for key in OUTPUT_HEADER:
-                    extracted_data[key] = ""
-
-                # --- Fetch ---
-                try:
-                    random_user_agent = random.choice(USER_AGENTS)
-                    headers = {'User-Agent': random_user_agent}
-                    response = requests.get(input_url, headers=headers, timeout=15) # Slightly longer timeout
-                    response.raise_for_status() # Check for HTTP errors (4xx, 5xx)
-                    fetch_successful = True
-                except requests.exceptions.Timeout:
-                    print(f"Timeout fetching URL (Item {item_num}, ID: {input_id}): {input_url}", file=sys.stderr)
-                    error_count += 1
-                except requests.exceptions.RequestException as e:
-                    print(f"Error fetching URL (Item {item_num}, ID: {input_id}): {input_url} - {e}", file=sys.stderr)
-                    error_count += 1
-
-                # --- Parse & Extract ---
-                if fetch_successful:
-                    try:
-                        # Ensure response content is not None before parsing
-                        if response.content:
-                            tree = html.fromstring(response.content)
-                            # Extract data using defined XPaths
-                            for key, xpath in XPATHS.items():
-                                extracted_data[key] = extract_data(tree, xpath)
-                        else:
-                             print(f"Empty content received (Item {item_num}, ID: {input_id}): {input_url}", file=sys.stderr)
-                             error_count += 1
-
-                    except Exception as e:
-                        # Catch potential parsing errors from lxml
-                        print(f"Error parsing HTML (Item {item_num}, ID: {input_id}): {input_url} - {e}", file=sys.stderr)
-                        error_count += 1
-                        # Ensure data fields remain empty if parsing fails mid-way
-                        for key in OUTPUT_HEADER:
-                            if key not in extracted_data or extracted_data[key] is None:
-                                extracted_data[key] = ""
-
-                # --- Process Correct Answer (Adapted from process_data.py) ---
-                correct_answer_key = extracted_data.get('Correct Answer', '').strip().upper() # Normalize key
-
-                # Create a mapping from answer key ('A', 'B', ...) to the extracted answer text
-                answer_map = {
-                    'A': extracted_data.get('Answer 1', ''),
-                    'B': extracted_data.get('Answer 2', ''),
-                    'C': extracted_data.get('Answer 3', ''),
-                    'D': extracted_data.get('Answer 4', ''),
-                    'E': extracted_data.get('Answer 5', '')
-                }
-
-                # Build the final correct answer string dynamically
-                result_answers = []
-                for char_key in correct_answer_key:
-                    # Get the answer corresponding to the character key from the map
-                    answer_text = answer_map.get(char_key)
-                    # Append the answer text if the key was valid (A-E) and text was found
-                    if answer_text is not None:
-                         # Only append non-empty answers to avoid extra newlines for missing optional answers
-                         if answer_text:
-                            result_answers.append(answer_text)
-
-                # Join the collected answers with newline characters
-                # If correct_answer_key was invalid or all corresponding answers were empty, this will be empty.
-                extracted_data['Correct Answer'] = "; ".join(result_answers)
-
-                # --- Write ---
-                # Ensure the order matches OUTPUT_HEADER
-                output_row = [extracted_data.get(col, "") for col in OUTPUT_HEADER]
-                writer.writerow(output_row)
+            pending = deque()
+
+            def write_next():
+                nonlocal processed_count, error_count
+                url, resumed, future = pending.popleft()
+                output_row, errors = future.result()
+                error_count += errors
+                if journal and not resumed:
+                    if errors:
+                        journal.record_failure()
+                    else:
+                        journal.record(url, output_row)
+                if output_row is None:
+                    return
+                if refresh:
+                    output_row = refresh.record(url, output_row, failed=errors > 0)
+                with stats.timer('detail/write'):
+                    writer.write_row(output_row)
                 processed_count += 1
 
                 # Optional: Print progress
                 if processed_count % 50 == 0:
                     print(f"Processed {processed_count} items...")
 
+            for item_num, item in enumerate(scraped_items, start=1):
+                journaled_row = journal.row(item.url) if journal else None
+                if journaled_row is not None:
+                    future = Future()
+                    future.set_result((journaled_row, 0))
+                    resumed_count += 1
+                else:
+                    future = executor.submit(worker, item_num, item)
+                pending.append((item.url, journaled_row is not None, future))
+                if len(pending) >= max_pending:
+                    write_next()
+
+            while pending:
+                write_next()
+
     except IOError as e:
-        print(f"Error writing to output file {output_csv_path}: {e}", file=sys.stderr)
+        print(f"Error writing to output file {output_path}: {e}", file=sys.stderr)
         # Decide if this should halt the whole process or just log
         # For now, we let the exception propagate up if needed.
         raise # Re-raise the exception for the caller (Typer command) to handle
     except Exception as e:
         print(f"An unexpected error occurred during processing: {e}", file=sys.stderr)
         raise # Re-raise
+    finally:
+        for session in sessions:
+            if session_pool:
+                session_pool.release(session)
+            else:
+                session.close()
+        if parser:
+            parser.shutdown()
+        if journal:
+            journal.close()
+        stats.add_time('detail/total', time.perf_counter() - start_time)
+        stats.inc('detail/items_written', processed_count)
+        stats.inc('detail/items_resumed', resumed_count)
+        stats.inc('detail/items_with_errors', error_count)
+        stats.inc('detail/throttled_responses', limiter.throttled)
 
     print(f"\nProcessing complete.")
     print(f"Total items processed successfully: {processed_count}")
-    print(f"Items with fetch/parse errors: {error_count}")
\ No newline at end of file
+    if resumed_count:
+        print(f"Items reused from the journal: {resumed_count}")
+    print(f"Items with fetch/parse errors: {error_count}")
+    if limiter.retries or limiter.throttled:
+        print(f"Retried requests: {limiter.retries} ({limiter.throttled} throttled responses), "
+              f"final concurrency: {int(limiter.limit)}")
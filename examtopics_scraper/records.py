@@ -0,0 +1,103 @@
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Union
+
+# Question number of the columns when a record has none
+NO_QUESTION = -1
+
+
+def intern_text(text: Optional[str]) -> Optional[str]:
+    """`text` interned, so the few distinct topics (or providers) of a run are each stored once."""
+    return sys.intern(text) if isinstance(text, str) else text
+
+
+@dataclass(slots=True)
+class QuestionRecord:
+    """
+    A question of an exam as found in the discussion listing or an index:
+    its number, topic (interned) and discussion URL. This is the item
+    ExamtopicsQuestionsSpider yields and the detail stage consumes.
+    """
+    question: Optional[int]
+    topic: Optional[str]
+    url: str
+
+    @classmethod
+    def from_item(cls, item: Union['QuestionRecord', Mapping[str, Any]]) -> 'QuestionRecord':
+        """The record of a spider item: a QuestionRecord, or a mapping with 'question' (or 'id'), 'topic' and 'url'."""
+        if isinstance(item, cls):
+            return item
+        question = item.get('question', item.get('id'))
+        return cls(int(question) if question is not None else None, intern_text(item.get('topic')), item.get('url'))
+
+
+@dataclass(slots=True)
+class QuestionPage:
+    """
+    A question page fetched by ExamtopicsQuestionsSpider itself (Scrapy
+    detail engine): the fields of its QuestionRecord, its discovery number
+    `seq` and the page `body`, None if the request failed.
+    """
+    question: Optional[int]
+    topic: Optional[str]
+    url: str
+    seq: int
+    body: Optional[bytes]
+
+
+class QuestionColumns:
+    """
+    Question records held as columns: the question numbers in an array, the
+    topics as indexes into a table of distinct topics, and the URLs in a
+    list. That is a few bytes per question besides its URL, instead of one
+    dict (or record) object each, for exams resolved from a provider index.
+
+    Iterating yields QuestionRecords built on the fly. `drain` also drops
+    each URL once its record has been yielded, so a run only keeps the
+    questions still pending.
+    """
+
+    __slots__ = ('_questions', '_topic_ids', '_topics', '_topic_table', '_urls', '_start')
+
+    def __init__(self, records: Iterable[QuestionRecord] = ()):
+        self._questions = array('q')
+        self._topic_ids = array('I')
+        self._topics: List[Optional[str]] = []
+        self._topic_table: Dict[Optional[str], int] = {}
+        self._urls: List[Optional[str]] = []
+        self._start = 0
+        self.extend(records)
+
+    def append(self, record: QuestionRecord):
+        topic_id = self._topic_table.get(record.topic)
+        if topic_id is None:
+            topic_id = self._topic_table[record.topic] = len(self._topics)
+            self._topics.append(intern_text(record.topic))
+        self._questions.append(NO_QUESTION if record.question is None else record.question)
+        self._topic_ids.append(topic_id)
+        self._urls.append(record.url)
+
+    def extend(self, records: Iterable[QuestionRecord]):
+        for record in records:
+            self.append(record)
+
+    def __len__(self) -> int:
+        return len(self._urls) - self._start
+
+    def __iter__(self) -> Iterator[QuestionRecord]:
+        for index in range(self._start, len(self._urls)):
+            yield self._record(index)
+
+    def drain(self) -> Iterator[QuestionRecord]:
+        """Yields the remaining records in order, releasing each URL once yielded."""
+        while self._start < len(self._urls):
+            record = self._record(self._start)
+            self._urls[self._start] = None
+            self._start += 1
+            yield record
+
+    def _record(self, index: int) -> QuestionRecord:
+        question = self._questions[index]
+        return QuestionRecord(None if question == NO_QUESTION else question,
+                              self._topics[self._topic_ids[index]], self._urls[index])
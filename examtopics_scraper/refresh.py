@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Mapping, Optional
+
+from examtopics_scraper.processing import OUTPUT_HEADER
+from examtopics_scraper.writers import read_rows, write_atomically
+
+URL_COLUMN = OUTPUT_HEADER.index('URL')
+# Fields whose change makes a question "changed": the question text, the
+# revealed answer and the answer choices, not where it was found
+CONTENT_COLUMNS = [OUTPUT_HEADER.index(name) for name in OUTPUT_HEADER if name not in ('Question ID', 'Topic', 'URL')]
+
+
+def row_hash(row: List[str]) -> str:
+    """Hash of the content fields of an output row."""
+    content = json.dumps([row[column] for column in CONTENT_COLUMNS], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class DatasetRefresh:
+    """
+    Refresh of an existing output file against the live site.
+
+    The previous rows are loaded by URL, together with the HTTP validators
+    (ETag, Last-Modified) and content hashes stored in a sidecar JSON file
+    (<output>.meta.json). Question pages are requested conditionally, so
+    unchanged pages can be answered with 304 Not Modified, and the rows of
+    the new run are classified as added, changed or unchanged by their
+    content hash. Questions no longer listed are removed.
+
+    The detail stage writes the full, patched dataset; `finish` writes the
+    change set and the new metadata.
+    """
+
+    def __init__(self, output_path: str, meta_path: str, output_format: Optional[str] = None):
+        self.meta_path = meta_path
+        self.previous_rows: Dict[str, List[str]] = {}
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            for row in read_rows(output_path, OUTPUT_HEADER, output_format):
+                if row[URL_COLUMN]:
+                    self.previous_rows[row[URL_COLUMN]] = row
+        self.previous_meta: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as meta_file:
+                self.previous_meta = json.load(meta_file)
+        self.meta: Dict[str, Dict[str, str]] = {}
+        self.changes: List[Dict[str, object]] = []
+        self.counts = dict.fromkeys(('added', 'changed', 'unchanged', 'removed', 'failed'), 0)
+        self._validators: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """If-None-Match/If-Modified-Since headers for `url`, if its previous row and validators are known."""
+        validators = self.previous_meta.get(url, {})
+        headers = {}
+        if url in self.previous_rows:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def previous_row(self, url: str) -> Optional[List[str]]:
+        return self.previous_rows.get(url)
+
+    def store_validators(self, url: str, response_headers: Mapping[str, str]):
+        """Keeps the validators of a fresh (200) response of `url` for the next refresh."""
+        validators = {key: response_headers[header] for key, header in
+                      (('etag', 'ETag'), ('last_modified', 'Last-Modified')) if response_headers.get(header)}
+        with self._lock:
+            self._validators[url] = validators
+
+    def record(self, url: str, row: List[str], failed: bool = False) -> List[str]:
+        """
+        Classifies the row of `url` for the new dataset, in dataset order, and
+        returns the row to write: the previous one if the question could not
+        be fetched this time.
+        """
+        previous = self.previous_rows.get(url)
+        if failed:
+            self.counts['failed'] += 1
+            if previous is not None:
+                # Keep the known row rather than blanking it
+                row = previous
+        with self._lock:
+            validators = self._validators.pop(url, None)
+        if validators is None:
+            # Not modified, failed or served from the cache: keep the validators we had
+            validators = {key: value for key, value in self.previous_meta.get(url, {}).items() if key != 'hash'}
+
+        content_hash = row_hash(row)
+        self.meta[url] = dict(validators, hash=content_hash)
+        if failed and previous is None:
+            return row
+        if previous is None:
+            change = 'added'
+        elif row_hash(previous) != content_hash:
+            change = 'changed'
+        else:
+            self.counts['unchanged'] += 1
+            return row
+        self.counts[change] += 1
+        self.changes.append({'change': change, 'url': url, 'row': dict(zip(OUTPUT_HEADER, row))})
+        return row
+
+    def finish(self, changes_path: str):
+        """
+        Records the questions no longer listed as removed, then writes the
+        change set (JSON Lines) and the new metadata. Only call it after a
+        complete run: an interrupted one would report missing questions as
+        removed.
+        """
+        for url, row in self.previous_rows.items():
+            if url not in self.meta:
+                self.counts['removed'] += 1
+                self.changes.append({'change': 'removed', 'url': url, 'row': dict(zip(OUTPUT_HEADER, row))})
+        write_atomically(changes_path, "".join(json.dumps(change, ensure_ascii=False) + "\n"
+                                               for change in self.changes))
+        write_atomically(self.meta_path, json.dumps(self.meta, indent=1))
+
+    def summary(self) -> str:
+        return ", ".join(f"{count} {name}" for name, count in self.counts.items())
@@ -0,0 +1,291 @@
+import itertools
+import json
+import queue
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import itemadapter
+from scrapy import signals
+from scrapy.crawler import Crawler, CrawlerRunner
+from scrapy.settings import Settings
+from scrapy.utils.log import configure_logging
+from scrapy.utils.reactor import install_reactor
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+from twisted.web import resource, server
+
+from examtopics_scraper.cache import cache_from_settings
+from examtopics_scraper.defaults import DEFAULT_MAX_JOBS
+from examtopics_scraper.exporters import HANDOFF_QUEUE_SIZE, run_detail_stage
+from examtopics_scraper.processing import SessionPool
+from examtopics_scraper.spiders import ExamtopicsExamsSpider, ExamtopicsQuestionsSpider
+from examtopics_scraper.stats import RunStats
+from examtopics_scraper.writers import OutputFormat, output_format_for
+
+# Finished jobs kept for GET /jobs; the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+
+JOB_COMMANDS = ("list-exams", "scrape")
+
+# Reactor installed when TWISTED_REACTOR is unset (its default before Scrapy 2.13)
+DEFAULT_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+
+
+class JobError(Exception):
+    """A job request that cannot be run, or a job that did not complete."""
+
+
+class Job:
+    """One list-exams or scrape request of the service, with its own stats and result."""
+
+    def __init__(self, job_id: str, command: str, params: Dict[str, Any]):
+        self.id = job_id
+        self.command = command
+        self.params = params
+        self.status = "queued"
+        self.result: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.stats = RunStats()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'command': self.command,
+            'params': self.params,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'counters': self.stats.as_dict()['counters'],
+        }
+
+
+class ScrapeService:
+    """
+    Long-running scraper serving list-exams and scrape jobs over a local
+    HTTP/JSON API, so a batch of exams pays the Scrapy/Twisted startup once.
+
+    Every job runs its own crawler, in one reactor and CrawlerRunner, with its
+    own item queue, output file and RunStats. The keep-alive sessions of the
+    detail stage (SessionPool), the response cache and Scrapy's DNS cache are
+    shared by all jobs. At most `max_jobs` jobs run at once; the others wait.
+
+    API:
+        POST /jobs      {"command": "list-exams", "provider": ...} or
+                        {"command": "scrape", "provider": ..., "exam_code": ...,
+                         "output": ..., "format": ..., "concurrency": ...,
+                         "max_retries": ...}; answers 202 with the job.
+        GET /jobs       Every known job.
+        GET /jobs/<id>  One job: status (queued, running, finished, failed),
+                        result (the exams, or the output file and question
+                        count) and detail stage counters.
+
+    Scrape outputs are written under `output_dir`; `output` defaults to
+    <exam code>.<format>.
+    """
+
+    def __init__(self, settings: Settings, output_dir: Path, max_jobs: int = DEFAULT_MAX_JOBS,
+                 concurrency: Optional[int] = None, max_retries: Optional[int] = None):
+        self.settings = settings
+        self.output_dir = output_dir
+        self.max_jobs = max_jobs
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.jobs: Dict[str, Job] = {}
+        self._job_ids = itertools.count(1)
+
+    def serve(self, host: str, port: int):
+        """Starts the reactor and the API, and blocks until interrupted."""
+        # Scrapy only checks the reactor when a crawl starts: install the one it expects first
+        install_reactor(self.settings['TWISTED_REACTOR'] or DEFAULT_REACTOR, self.settings['ASYNCIO_EVENT_LOOP'])
+        configure_logging(self.settings)
+        from twisted.internet import reactor
+
+        self.runner = CrawlerRunner(self.settings)
+        self.semaphore = defer.DeferredSemaphore(self.max_jobs)
+        self.session_pool = SessionPool()
+        self.cache = cache_from_settings(self.settings)
+        # Detail stages block on their item queue: they get threads of their own,
+        # and every waiting ItemQueuePipeline.put one of the reactor's
+        self.detail_pool = ThreadPool(minthreads=0, maxthreads=self.max_jobs, name="detail-stage")
+        self.detail_pool.start()
+        reactor.suggestThreadPoolSize(max(self.settings.getint('REACTOR_THREADPOOL_MAXSIZE'), self.max_jobs * 2))
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.runner.stop)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._close)
+        reactor.listenTCP(port, server.Site(JobsResource(self)), interface=host)
+        print(f"Serving scrape jobs on http://{host}:{port}/jobs (Ctrl-C to stop)...")
+        reactor.run()
+
+    def _close(self):
+        self.detail_pool.stop()
+        self.session_pool.close()
+        if self.cache:
+            self.cache.close()
+
+    def submit(self, request: Dict[str, Any]) -> Job:
+        """Validates a job request and queues it. Raises JobError if it is invalid."""
+        command = request.get('command')
+        if command not in JOB_COMMANDS:
+            raise JobError(f"'command' must be one of {', '.join(JOB_COMMANDS)}")
+        params = {key: value for key, value in request.items() if key != 'command'}
+        if not isinstance(params.get('provider'), str) or not params['provider']:
+            raise JobError("'provider' is required")
+        if command == "scrape":
+            if not isinstance(params.get('exam_code'), str) or not params['exam_code']:
+                raise JobError("'exam_code' is required")
+            for key in ('output', 'format'):
+                if params.get(key) is not None and not isinstance(params[key], str):
+                    raise JobError(f"'{key}' must be a string")
+            # Like the CLI: an explicit format, or that of the output extension (CSV by default)
+            try:
+                output_format = output_format_for(params.get('output') or "", params.get('format'))
+            except ValueError:
+                raise JobError(f"'format' must be one of {', '.join(f.value for f in OutputFormat)}")
+            output = (self.output_dir / (params.get('output') or f"{params['exam_code']}.{output_format.value}")).resolve()
+            if not output.is_relative_to(self.output_dir.resolve()):
+                raise JobError("'output' must be inside the output directory of the service")
+            # Two jobs writing (and journaling) the same file would interleave their rows
+            if active := self._active_job_writing(output):
+                raise JobError(f"Job {active.id} ({active.status}) already writes to '{output.name}'")
+            params.update(output=str(output), format=output_format.value)
+            if 'concurrency' in params and not (isinstance(params['concurrency'], int) and params['concurrency'] >= 1):
+                raise JobError("'concurrency' must be a positive integer")
+            if 'max_retries' in params and not (isinstance(params['max_retries'], int) and params['max_retries'] >= 0):
+                raise JobError("'max_retries' must be a non-negative integer")
+
+        job = Job(str(next(self._job_ids)), command, params)
+        self.jobs[job.id] = job
+        self._forget_finished_jobs()
+        self.semaphore.run(lambda: defer.ensureDeferred(self._run(job)))
+        return job
+
+    def _active_job_writing(self, output: Path) -> Optional[Job]:
+        """The queued or running scrape job whose output file is `output`, if any."""
+        for job in self.jobs.values():
+            if job.command == "scrape" and job.finished_at is None and Path(job.params['output']) == output:
+                return job
+        return None
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    async def _run(self, job: Job):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            if job.command == "list-exams":
+                job.result = await self._list_exams(job)
+            else:
+                job.result = await self._scrape(job)
+            job.status = "finished"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+            print(f"Job {job.id} ({job.command}) failed: {job.error}", file=sys.stderr)
+        finally:
+            job.finished_at = time.time()
+
+    def _crawler(self, spidercls, pipelines: Dict[str, int]):
+        """A crawler of `spidercls` with its own copy of the settings and its item `pipelines`."""
+        settings = self.settings.copy()
+        settings['ITEM_PIPELINES'] = pipelines
+        return Crawler(spidercls, settings)
+
+    async def _crawl(self, job: Job, crawler, **spider_kwargs):
+        try:
+            await self.runner.crawl(crawler, **spider_kwargs)
+        finally:
+            if crawler.stats:
+                job.stats.merge_scrapy(crawler.stats.get_stats())
+        reason = crawler.stats.get_value('finish_reason')
+        if reason != 'finished':
+            raise JobError(f"The crawl did not finish ({reason})")
+
+    async def _list_exams(self, job: Job) -> List[Dict[str, Any]]:
+        exams = []
+
+        def collect(item):
+            exams.append(itemadapter.ItemAdapter(item).asdict())
+
+        crawler = self._crawler(ExamtopicsExamsSpider, {})
+        crawler.signals.connect(collect, signal=signals.item_scraped)
+        await self._crawl(job, crawler, provider=job.params['provider'])
+        return exams
+
+    async def _scrape(self, job: Job) -> Dict[str, Any]:
+        from twisted.internet import reactor
+
+        params = job.params
+        output_path = Path(params['output'])
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        detail_options = {'stats': job.stats, 'session_pool': self.session_pool,
+                          'output_format': params.get('format')}
+        for key, default in (('concurrency', self.concurrency), ('max_retries', self.max_retries)):
+            if params.get(key, default) is not None:
+                detail_options[key] = params.get(key, default)
+
+        item_queue = queue.Queue(maxsize=HANDOFF_QUEUE_SIZE)
+        detail = threads.deferToThreadPool(reactor, self.detail_pool, run_detail_stage, item_queue,
+                                           str(output_path), detail_options, self.cache)
+        crawler = self._crawler(ExamtopicsQuestionsSpider, {'examtopics_scraper.exporters.ItemQueuePipeline': 1})
+        try:
+            await self._crawl(job, crawler, provider=params['provider'], exam_code=params['exam_code'],
+                              item_queue=item_queue)
+        finally:
+            # End of stream: the put waits for room in the queue, off the reactor thread
+            await threads.deferToThread(item_queue.put, None)
+            item_count = await detail
+        if not item_count:
+            raise JobError("No questions were collected (check the exam code and the service log)")
+        counters = job.stats.as_dict()['counters']
+        return {'output': str(output_path), 'questions': item_count,
+                'errors': counters.get('detail/items_with_errors', 0)}
+
+
+class JobsResource(resource.Resource):
+    """twisted.web resource of the ScrapeService API (see ScrapeService)."""
+
+    isLeaf = True
+
+    def __init__(self, service: ScrapeService):
+        super().__init__()
+        self.service = service
+
+    def render_GET(self, request):
+        path = [segment for segment in request.postpath if segment]
+        if path == [b'jobs']:
+            return respond(request, 200, [job.as_dict() for job in self.service.jobs.values()])
+        if len(path) == 2 and path[0] == b'jobs':
+            job = self.service.jobs.get(path[1].decode('utf-8', 'replace'))
+            if job:
+                return respond(request, 200, job.as_dict())
+        return respond(request, 404, {'error': "Not found"})
+
+    def render_POST(self, request):
+        if [segment for segment in request.postpath if segment] != [b'jobs']:
+            return respond(request, 404, {'error': "Not found"})
+        try:
+            body = json.loads(request.content.read() or b'{}')
+            if not isinstance(body, dict):
+                raise JobError("The request body must be a JSON object")
+            job = self.service.submit(body)
+        except (JobError, ValueError) as e:
+            return respond(request, 400, {'error': str(e)})
+        return respond(request, 202, job.as_dict())
+
+
+def respond(request, code: int, body: Any) -> bytes:
+    """Sets the status code and JSON content type of a twisted.web `request`, and returns its body."""
+    request.setResponseCode(code)
+    request.setHeader(b'content-type', b'application/json')
+    return json.dumps(body, indent=1).encode('utf-8') + b"\n"
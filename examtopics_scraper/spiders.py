@@ -1,7 +1,43 @@
+import bisect
+import random
 import re
 
 import scrapy
 
+from examtopics_scraper.defaults import BASE_URL
+from examtopics_scraper.processing import USER_AGENTS
+from examtopics_scraper.records import QuestionPage, QuestionRecord, intern_text
+from examtopics_scraper.stats import LATENCY_BUCKETS
+from examtopics_scraper.watermark import MAX_KNOWN_URLS
+
+
+# Discussion listing pages after the first live under /discussions/<provider>/<page>/
+LISTING_PAGE_REGEX = re.compile(r"/discussions/[^/]+/(\d+)/?$")
+
+# Page indicator of the discussion listing, e.g. "Page 1 of 1234"
+PAGE_COUNT_REGEX = re.compile(r"Page\s+\d+\s+of\s+(\d+)", re.IGNORECASE)
+
+
+def base_url(spider):
+    """Site root for `spider`, from its EXAMTOPICS_BASE_URL setting if set."""
+    settings = getattr(spider, "settings", None)
+    return ((settings and settings.get("EXAMTOPICS_BASE_URL")) or BASE_URL).rstrip("/")
+
+
+def map_output(function, generator):
+    """Yields `function` of every output of `generator`, and returns the generator's own return value."""
+    while True:
+        try:
+            output = next(generator)
+        except StopIteration as stop:
+            return stop.value
+        yield function(output)
+
+
+def exam_question_regex(exam_code):
+    """Regex matching the discussion titles of `exam_code`, capturing topic and question number."""
+    return re.compile(fr"^\s+Exam {re.escape(exam_code)} (.*) question (\d+)", re.IGNORECASE)
+
 
 class ExamtopicsExamsSpider(scrapy.Spider):
     """Spider for ExamTopics exams."""
@@ -11,7 +47,14 @@ class ExamtopicsExamsSpider(scrapy.Spider):
     def __init__(self, provider, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.provider = provider
-        self.start_urls = [f"https://www.examtopics.com/exams/{self.provider}/"]
+
+    async def start(self):
+        # Scrapy >= 2.13 entry point; older versions call start_requests directly
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        yield scrapy.Request(f"{base_url(self)}/exams/{self.provider}/", dont_filter=True)
 
     def parse(self, response, **kwargs):
         for exam in response.css("a.popular-exam-link"):
@@ -21,26 +64,196 @@ class ExamtopicsExamsSpider(scrapy.Spider):
             }
 
 
-class ExamtopicsQuestionsSpider(scrapy.Spider):
-    """Spider for ExamTopics question discussions."""
+class ExamtopicsDiscussionListingSpider(scrapy.Spider):
+    """Base spider for the discussion listing of a provider.
 
-    name = "examtopics_questions"
+    The page count is read from the first listing page, and every other page
+    is requested at once (lower pages first), so the listing is crawled
+    CONCURRENT_REQUESTS pages at a time instead of one round trip after the
+    other. If the page count is not found, or `fan_out` is False, pages are
+    followed through their "next" links instead.
+
+    Fanned-out pages complete in any order. With `ordered`, the output of
+    each page is held back until every earlier page has been parsed (or has
+    failed), so the spider's output keeps the listing order (page, then rank
+    within the page) from one run to the next.
+
+    Subclasses implement `parse_discussions`. It may return False, as the
+    value of the generator, to stop following "next" links from that page.
+    Its outputs are passed through `release` when the spider yields them.
+    """
 
-    def __init__(self, provider, exam_code, *args, **kwargs):
+    ordered = False
+
+    def __init__(self, provider, *args, fan_out=True, **kwargs):
         super().__init__(*args, **kwargs)
-        self.exam_code = exam_code
         self.provider = provider
-        self.question_regex = re.compile(fr"^\s+Exam {self.exam_code} (.*) question (\d+)",
-                                         re.IGNORECASE)
-        self.start_urls = [f"https://www.examtopics.com/discussions/{self.provider}/"]
+        self.fan_out = fan_out
+        self.pending_pages = {} # Outputs of fanned-out pages waiting for earlier pages, by page
+        self.next_page = 2
+
+    async def start(self):
+        # Scrapy >= 2.13 entry point; older versions call start_requests directly
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        yield scrapy.Request(self.listing_page_url(1), dont_filter=True, errback=self.listing_page_failed)
+
+    def listing_page_url(self, page):
+        if page == 1:
+            return f"{base_url(self)}/discussions/{self.provider}/"
+        return f"{base_url(self)}/discussions/{self.provider}/{page}/"
 
     def parse(self, response, **kwargs):
+        self.crawler.stats.inc_value("examtopics/listing_pages")
+        discussions = self.parse_discussions(response)
+        if response.meta.get("fanned_out"):
+            yield from self.page_parsed(response.meta["page"], list(discussions))
+            return
+        follow = yield from map_output(self.release, discussions)
+        page_count = self.page_count(response) if self.fan_out else None
+        if page_count:
+            self.logger.info(f"Discussion listing has {page_count} pages, requesting all of them.")
+            for page in range(2, page_count + 1):
+                # Duplicates of pages reached otherwise are dropped by the scheduler's dupefilter
+                yield scrapy.Request(self.listing_page_url(page), callback=self.parse, priority=-page,
+                                     errback=self.listing_page_failed, meta={"fanned_out": True, "page": page})
+        elif follow is not False:
+            if next_page := response.css("span.pagination-nav>a.btn.btn-sm"):
+                yield from response.follow_all(next_page, callback=self.parse, errback=self.listing_page_failed)
+
+    @staticmethod
+    def page_count(response):
+        text = " ".join(response.css(".discussion-list-page-indicator ::text, span.pagination-nav ::text").getall())
+        if match := PAGE_COUNT_REGEX.search(text):
+            return int(match.group(1))
+        return None
+
+    def parse_discussions(self, response):
+        raise NotImplementedError
+
+    def release(self, output):
+        """What the spider yields for an output of `parse_discussions`: the output itself by default."""
+        return output
+
+    def page_parsed(self, page, outputs):
+        """Yields the outputs of fanned-out `page`, or, if `ordered`, of every page it no longer holds back."""
+        if not self.ordered:
+            yield from map(self.release, outputs)
+            return
+        self.pending_pages[page] = outputs
+        while self.next_page in self.pending_pages:
+            yield from map(self.release, self.pending_pages.pop(self.next_page))
+            self.next_page += 1
+
+    def listing_page_failed(self, failure):
+        self.crawler.stats.inc_value("examtopics/listing_pages_failed")
+        self.logger.error(f"Error fetching listing page: {failure.request.url} - {failure.value}")
+        if failure.request.meta.get("fanned_out"):
+            # Its discussions are lost, the later pages need not wait for them
+            yield from self.page_parsed(failure.request.meta["page"], [])
+
+    def closed(self, reason):
+        if held := sum(len(outputs) for outputs in self.pending_pages.values()):
+            self.logger.warning(f"{held} discussions of listing pages after a page that never completed "
+                                f"were not yielded.")
+
+
+class ExamtopicsQuestionsSpider(ExamtopicsDiscussionListingSpider):
+    """Spider for ExamTopics question discussions.
+
+    Matched questions are yielded as QuestionRecords, in listing order. With
+    `fetch_details`, the spider requests every matched question page instead
+    and yields it as a QuestionPage, numbered by `seq` in listing order. If `questions`
+    (records already resolved, e.g. from a DiscussionIndex) are given, the
+    listing is not crawled at all.
+
+    With `known_urls` (a HighWaterMark), known discussions are not yielded and
+    pagination stops at the first page made only of known discussions. This
+    relies on the newest-first order, so incremental crawls pass `fan_out=False`.
+    The first MAX_KNOWN_URLS discussion URLs crawled are collected in
+    `newest_urls`.
+    """
+
+    name = "examtopics_questions"
+    ordered = True
+
+    def __init__(self, provider, exam_code, *args, fetch_details=False, questions=None, known_urls=None, **kwargs):
+        super().__init__(provider, *args, **kwargs)
+        self.exam_code = exam_code
+        self.fetch_details = fetch_details
+        self.questions = questions
+        self.known_urls = known_urls
+        self.newest_urls = []
+        self.question_count = 0
+        self.question_regex = exam_question_regex(self.exam_code)
+
+    def start_requests(self):
+        if self.questions is None:
+            yield from super().start_requests()
+            return
+        for record in self.questions:
+            yield self.question_request(QuestionRecord.from_item(record))
+
+    def parse_discussions(self, response):
+        all_known = True
+        stats = self.crawler.stats
         for question in response.css("a.discussion-link"):
+            url = response.urljoin(question.attrib["href"])
+            stats.inc_value("examtopics/links_seen")
+            if len(self.newest_urls) < MAX_KNOWN_URLS:
+                self.newest_urls.append(url)
+            if self.known_urls is not None and url in self.known_urls:
+                stats.inc_value("examtopics/links_known")
+                continue
+            all_known = False
             if match := re.search(self.question_regex, question.css("::text").extract_first()):
-                yield {
-                    "question": int(match.group(2)),
-                    "topic": match.group(1),
-                    "url": response.urljoin(question.attrib["href"]),
-                }
-        if next_page := response.css("span.pagination-nav>a.btn.btn-sm"):
-            yield from response.follow_all(next_page, callback=self.parse)
+                stats.inc_value("examtopics/links_matched")
+                yield QuestionRecord(int(match.group(2)), intern_text(match.group(1)), url)
+        if self.known_urls is not None and all_known:
+            self.logger.info(f"Reached already known discussions at {response.url}, stopping pagination.")
+            return False
+        return True
+
+    def release(self, record):
+        return self.question_request(record) if self.fetch_details else record
+
+    def question_request(self, record):
+        """Request for a question page (only used with `fetch_details`)."""
+        seq = self.question_count
+        self.question_count += 1
+        # Same rotation as the requests-based detail stage
+        return scrapy.Request(record.url, callback=self.parse_question, errback=self.question_failed,
+                              headers={"User-Agent": random.choice(USER_AGENTS)},
+                              cb_kwargs={"record": record, "seq": seq}, dont_filter=True)
+
+    def parse_question(self, response, record, seq):
+        if (latency := response.meta.get("download_latency")) is not None:
+            # Same buckets as the requests-based stage's detail/fetch_seconds histogram
+            bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+            le = LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else "+Inf"
+            self.crawler.stats.inc_value(f"examtopics/fetch_seconds/le_{le}")
+        yield QuestionPage(record.question, record.topic, record.url, seq, response.body)
+
+    def question_failed(self, failure):
+        record, seq = failure.request.cb_kwargs["record"], failure.request.cb_kwargs["seq"]
+        self.logger.error(f"Error fetching URL (ID: {record.question}): {record.url} - {failure.value}")
+        # Keep the question in the output, with empty fields, like the requests-based stage
+        yield QuestionPage(record.question, record.topic, record.url, seq, None)
+
+
+class ExamtopicsDiscussionsSpider(ExamtopicsDiscussionListingSpider):
+    """Spider for every question discussion of a provider, regardless of the exam."""
+
+    name = "examtopics_discussions"
+
+    def parse_discussions(self, response):
+        page = int(match.group(1)) if (match := LISTING_PAGE_REGEX.search(response.url)) else 1
+        for rank, discussion in enumerate(response.css("a.discussion-link")):
+            yield {
+                "title": discussion.css("::text").extract_first(),
+                "url": response.urljoin(discussion.attrib["href"]),
+                "page": page,
+                "rank": rank,
+            }
@@ -0,0 +1,162 @@
+import bisect
+import cProfile
+import datetime
+import json
+import pstats
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from examtopics_scraper.writers import write_atomically
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prefix of every metric in Prometheus textfiles
+METRIC_PREFIX = "examtopics"
+
+
+class RunStats:
+    """
+    Thread-safe counters, timers and histograms of one run, e.g.
+    'detail/cache_hits', 'detail/parse' or 'detail/fetch_seconds'.
+
+    Scrapy's own stats collector is merged in under 'scrapy/' with
+    `merge_scrapy`, and everything is written as JSON or as a Prometheus
+    textfile with `write`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.timers: Dict[str, List[float]] = {} # name -> [count, total seconds, max seconds]
+        self.histograms: Dict[str, List[int]] = {} # name -> per-bucket counts, last one is +Inf
+        self.histogram_sums: Dict[str, float] = {}
+        self.scrapy: Dict[str, Any] = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Times the enclosed block into the timer `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        """Records `seconds` in the LATENCY_BUCKETS histogram `name`."""
+        with self._lock:
+            buckets = self.histograms.setdefault(name, [0] * (len(LATENCY_BUCKETS) + 1))
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.histogram_sums[name] = self.histogram_sums.get(name, 0.0) + seconds
+
+    def merge_scrapy(self, scrapy_stats: Dict[str, Any]):
+        """Adds the stats of a Scrapy crawler (crawler.stats.get_stats())."""
+        with self._lock:
+            self.scrapy.update(scrapy_stats)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {name: {'count': count, 'total_seconds': round(total, 6), 'max_seconds': round(max_, 6)}
+                           for name, (count, total, max_) in self.timers.items()},
+                'histograms': {
+                    name: {'buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], buckets)),
+                           'sum_seconds': round(self.histogram_sums[name], 6), 'count': sum(buckets)}
+                    for name, buckets in self.histograms.items()},
+                'scrapy': {key: value.isoformat() if isinstance(value, (datetime.datetime, datetime.date))
+                           else value for key, value in self.scrapy.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        """Renders the numeric stats in the Prometheus text exposition format."""
+        stats = self.as_dict()
+        lines = []
+
+        def metric(name: str, kind: str):
+            full_name = f"{METRIC_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]+', '_', name).strip('_')}"
+            lines.append(f"# TYPE {full_name} {kind}")
+            return full_name
+
+        for name, value in stats['counters'].items():
+            lines.append(f"{metric(name + '_total', 'counter')} {value}")
+        for name, timer in stats['timers'].items():
+            full_name = metric(name + '_seconds', 'summary')
+            lines.append(f"{full_name}_sum {timer['total_seconds']}")
+            lines.append(f"{full_name}_count {timer['count']}")
+        for name, histogram in stats['histograms'].items():
+            full_name = metric(name, 'histogram')
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'{full_name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{full_name}_sum {histogram['sum_seconds']}")
+            lines.append(f"{full_name}_count {histogram['count']}")
+        for name, value in stats['scrapy'].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"{metric('scrapy/' + name, 'gauge')} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Writes the stats as a Prometheus textfile if `path` ends with .prom, as JSON otherwise."""
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.as_dict(), indent=2)
+        # A textfile collector must never read a partial file
+        write_atomically(path, content)
+
+
+@contextmanager
+def profiled(path: Optional[str]):
+    """
+    Profiles the enclosed block with cProfile, including the threads it
+    starts (fetch workers, detail stage), and dumps pstats data to `path`.
+    Does nothing if `path` is None.
+    """
+    if not path:
+        yield
+        return
+
+    thread_profiles = []
+    lock = threading.Lock()
+
+    def profile_thread(*_):
+        # Runs once as the new thread's profile function, then hands over to cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return # Python 3.12+: the main profile already sees every thread
+        with lock:
+            thread_profiles.append((threading.current_thread(), profile))
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(profile_thread)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main_profile)
+        with lock:
+            for thread, profile in thread_profiles:
+                # Profiles of threads still running cannot be stopped from here
+                if not thread.is_alive():
+                    stats.add(profile)
+        stats.dump_stats(path)
+        print(f"Profile written to {path} (inspect it with: python -m pstats {path})")
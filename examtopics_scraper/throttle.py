@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Responses telling us to slow down: every request is paused and the
+# concurrency limit is halved
+THROTTLE_STATUSES = frozenset({429, 503})
+# Responses worth another attempt of the same question page
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+# Attempts of a question page after the first one, before it is given up
+DEFAULT_MAX_RETRIES = 3
+
+# Full-jitter exponential backoff: attempt n waits up to BACKOFF_BASE * 2**(n-1) seconds
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 60.0
+# Longest Retry-After we are willing to honour, in seconds
+MAX_RETRY_AFTER = 300.0
+
+# Responses slower than this multiple of the baseline latency count as congestion
+CONGESTION_LATENCY_RATIO = 3.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delay or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Random delay before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class AdaptiveLimiter:
+    """
+    Latency- and error-aware concurrency limit for the detail stage, in the
+    spirit of Scrapy's AutoThrottle.
+
+    The limit grows additively (about +1 per round of requests) while
+    responses are healthy, shrinks a little on errors and congestion (latency
+    well above its baseline), and is halved on 429/503 responses, which also
+    pause every request for their Retry-After delay or an exponential backoff.
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1, initial: Optional[int] = None):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = float(initial or max(self.min_concurrency, max_concurrency // 2))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.base_latency: Optional[float] = None
+        self.throttled = 0
+        self.retries = 0
+        self._throttle_streak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self._cond.wait(timeout=pause if pause > 0 else None)
+
+    def release(self, latency: Optional[float] = None, throttled: bool = False,
+                retry_after: Optional[float] = None, failed: bool = False):
+        """
+        Ends a request acquired with `acquire` and adapts the limit to its
+        outcome: a `throttled` (429/503) response, a `failed` one (other 5xx,
+        timeout, connection error), or a healthy one that took `latency` seconds.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self._throttle_streak += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                pause = retry_after if retry_after is not None else backoff_delay(self._throttle_streak)
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            elif failed:
+                self.limit = max(self.min_concurrency, self.limit * 0.9)
+            else:
+                self._throttle_streak = 0
+                if latency is not None:
+                    # Slowly drifting minimum, so one lucky response does not pin the baseline
+                    self.base_latency = latency if self.base_latency is None else \
+                        min(latency, self.base_latency * 0.99 + latency * 0.01)
+                if latency is not None and latency > self.base_latency * CONGESTION_LATENCY_RATIO:
+                    self.limit = max(self.min_concurrency, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def record_retry(self):
+        with self._cond:
+            self.retries += 1
@@ -0,0 +1,46 @@
+import json
+import os
+from typing import Dict, Iterable, List, Set
+
+from examtopics_scraper.writers import write_atomically
+
+# Number of newest discussion URLs remembered per exam. It only has to cover
+# the first listing pages: the crawl stops at the first page made only of
+# known discussions.
+MAX_KNOWN_URLS = 500
+
+
+class HighWaterMark:
+    """
+    Newest discussion URLs seen by the last scrape of each exam, stored in a
+    JSON file and keyed by "<provider>/<exam code>".
+
+    The discussion listing is ordered newest-first, so an incremental crawl can
+    stop paginating at the first page whose discussions are all known.
+    Marks are kept per exam, not per provider: a scrape of one exam skips the
+    other exams' new questions, so they must not count as seen for them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.marks: Dict[str, List[str]] = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as state_file:
+                self.marks = json.load(state_file)
+
+    @staticmethod
+    def key(provider: str, exam_code: str) -> str:
+        return f"{provider}/{exam_code}"
+
+    def known_urls(self, provider: str, exam_code: str) -> Set[str]:
+        return set(self.marks.get(self.key(provider, exam_code), []))
+
+    def update(self, provider: str, exam_code: str, newest_urls: Iterable[str]):
+        """Puts `newest_urls` (newest first) in front of the known URLs of the exam."""
+        key = self.key(provider, exam_code)
+        # dict.fromkeys de-duplicates while keeping the newest-first order
+        urls = dict.fromkeys([*newest_urls, *self.marks.get(key, [])])
+        self.marks[key] = list(urls)[:MAX_KNOWN_URLS]
+
+    def save(self):
+        write_atomically(self.path, json.dumps(self.marks, indent=1))
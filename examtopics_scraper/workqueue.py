@@ -0,0 +1,310 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from examtopics_scraper.cache import ResponseCache
+from examtopics_scraper.defaults import DEFAULT_CONCURRENCY, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, DEFAULT_SHARD_SIZE
+from examtopics_scraper.processing import SessionPool, build_output_row, fetch_and_extract
+from examtopics_scraper.records import QuestionRecord, intern_text
+from examtopics_scraper.stats import RunStats
+from examtopics_scraper.throttle import DEFAULT_MAX_RETRIES, AdaptiveLimiter
+
+# Seconds an idle worker waits before looking for a claimable shard again
+POLL_INTERVAL = 1.0
+
+
+@dataclass
+class Shard:
+    """A leased shard: its id, lease count and the questions still to fetch, as (seq, record)."""
+    id: int
+    attempts: int
+    tasks: List[Tuple[int, QuestionRecord]] = field(default_factory=list)
+
+
+class WorkQueue:
+    """
+    Work queue of the question pages of one exam, shared through a SQLite
+    file by a coordinator and any number of worker processes.
+
+    The coordinator adds the questions found by the listing crawl in
+    listing order, grouped into shards of `shard_size`. A shard can be
+    claimed once it is full or the listing is sealed. Workers claim a shard
+    under a lease, renew the lease while fetching, and complete the shard with
+    the rows of its questions. Leases that expire (e.g. the worker crashed)
+    are reclaimed by the next claim. Once every shard is done, `rows` yields
+    the output in listing order.
+
+    The file uses SQLite's rollback journal, not WAL (which needs shared
+    memory between the processes, so a single machine): workers on other
+    machines can share it only through a filesystem whose locks SQLite can
+    rely on. Many network filesystems (NFS, SMB) lock unreliably, and the
+    queue can then hand the same shard to two workers.
+
+    A single instance can be used from several threads.
+    """
+
+    def __init__(self, path: str, shard_size: int = DEFAULT_SHARD_SIZE):
+        self.path = path
+        self.shard_size = shard_size
+        self._lock = threading.Lock()
+        # Autocommit mode: transactions are explicit (see _transaction)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._conn.executescript("""
+            PRAGMA journal_mode=DELETE;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                shard INTEGER PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'open', -- open, pending, leased or done
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                shard INTEGER NOT NULL,
+                question TEXT,
+                topic TEXT,
+                url TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending', -- pending, done or failed
+                row TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tasks_shard ON tasks (shard);
+            CREATE INDEX IF NOT EXISTS shards_status ON shards (status);
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes
+        # claiming at once queue up instead of claiming the same shard
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def meta(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, value FROM meta"))
+
+    # --- Coordinator side ---
+
+    def begin(self, provider: str, exam_code: str):
+        """Records the exam of the queue. A queue can be re-filled for the same exam only."""
+        with self._transaction() as conn:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if meta and (meta.get('provider'), meta.get('exam_code')) != (provider, exam_code):
+                raise ValueError(f"{self.path} is the work queue of {meta.get('provider')}/{meta.get('exam_code')}")
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             [('provider', provider), ('exam_code', exam_code)])
+
+    def add(self, questions: Iterable[QuestionRecord]) -> int:
+        """
+        Adds question records in listing order, skipping known URLs.
+        Returns the number of new questions.
+        """
+        added = 0
+        with self._transaction() as conn:
+            shard, shard_count = self._open_shard(conn)
+            for question in questions:
+                if shard is None:
+                    shard, shard_count = conn.execute("INSERT INTO shards (status) VALUES ('open')").lastrowid, 0
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO tasks (shard, question, topic, url) VALUES (?, ?, ?, ?)",
+                    (shard, question.question, question.topic, question.url)).rowcount
+                added += inserted
+                shard_count += inserted
+                if shard_count >= self.shard_size:
+                    conn.execute("UPDATE shards SET status = 'pending' WHERE shard = ?", (shard,))
+                    shard = None
+        return added
+
+    @staticmethod
+    def _open_shard(conn) -> Tuple[Optional[int], int]:
+        row = conn.execute("SELECT shard FROM shards WHERE status = 'open' ORDER BY shard LIMIT 1").fetchone()
+        if row is None:
+            return None, 0
+        return row[0], conn.execute("SELECT COUNT(*) FROM tasks WHERE shard = ?", (row[0],)).fetchone()[0]
+
+    def seal(self):
+        """Marks the listing as complete: the last, partial shard becomes claimable."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE shards SET status = 'pending' WHERE status = 'open'")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sealed', ?)", (str(time.time()),))
+
+    # --- Worker side ---
+
+    def claim(self, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+              max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> Optional[Shard]:
+        """
+        Leases the first pending shard, or one whose lease expired, to `worker`
+        for `lease_seconds`. A shard already leased `max_attempts` times is
+        given up instead: its unfinished questions are marked failed. Returns
+        None if no shard can be claimed right now.
+        """
+        with self._transaction() as conn:
+            while True:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT shard, attempts FROM shards WHERE status = 'pending' "
+                    "OR (status = 'leased' AND lease_expires < ?) ORDER BY shard LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                shard, attempts = row
+                if attempts >= max_attempts:
+                    conn.execute("UPDATE tasks SET status = 'failed' WHERE shard = ? AND status = 'pending'", (shard,))
+                    conn.execute("UPDATE shards SET status = 'done', worker = NULL, lease_expires = NULL "
+                                 "WHERE shard = ?", (shard,))
+                    continue
+                conn.execute("UPDATE shards SET status = 'leased', worker = ?, lease_expires = ?, "
+                             "attempts = attempts + 1 WHERE shard = ?", (worker, now + lease_seconds, shard))
+                tasks = [(seq, QuestionRecord(question, intern_text(topic), url)) for seq, question, topic, url in
+                         conn.execute("SELECT seq, question, topic, url FROM tasks "
+                                      "WHERE shard = ? AND status != 'done' ORDER BY seq", (shard,))]
+                return Shard(shard, attempts + 1, tasks)
+
+    def renew(self, shard: int, worker: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Extends the lease of `worker` on `shard`. Returns False if the lease was lost."""
+        with self._transaction() as conn:
+            return conn.execute("UPDATE shards SET lease_expires = ? WHERE shard = ? AND worker = ? "
+                                "AND status = 'leased'", (time.time() + lease_seconds, shard, worker)).rowcount > 0
+
+    def release(self, shard: int, worker: str):
+        """Gives a leased shard back without results (e.g. the worker is stopping)."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE shards SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                         "attempts = MAX(attempts - 1, 0) WHERE shard = ? AND worker = ? AND status = 'leased'",
+                         (shard, worker))
+
+    def complete(self, shard: int, worker: str, results: Iterable[Tuple[int, List[str], bool]],
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> bool:
+        """
+        Stores the (seq, row, failed) results of a shard leased by `worker`.
+        Failed questions make the shard pending again until it has been leased
+        `max_attempts` times. Returns False, storing nothing, if the lease was
+        lost to another worker in the meantime.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts FROM shards WHERE shard = ? AND worker = ? AND status = 'leased'",
+                               (shard, worker)).fetchone()
+            if row is None:
+                return False
+            any_failed = False
+            for seq, output_row, failed in results:
+                any_failed = any_failed or failed
+                conn.execute("UPDATE tasks SET status = ?, row = ? WHERE seq = ?",
+                             ('failed' if failed else 'done', json.dumps(output_row), seq))
+            retry = any_failed and row[0] < max_attempts
+            if retry:
+                conn.execute("UPDATE tasks SET status = 'pending' WHERE shard = ? AND status = 'failed'", (shard,))
+            conn.execute("UPDATE shards SET status = ?, worker = NULL, lease_expires = NULL WHERE shard = ?",
+                         ('pending' if retry else 'done', shard))
+            return True
+
+    # --- Progress and merge ---
+
+    def progress(self) -> Dict[str, Any]:
+        """Shard and question counts by status, and whether the listing is sealed."""
+        with self._lock:
+            return {
+                'sealed': self._conn.execute("SELECT 1 FROM meta WHERE key = 'sealed'").fetchone() is not None,
+                'shards': dict(self._conn.execute("SELECT status, COUNT(*) FROM shards GROUP BY status")),
+                'questions': dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status")),
+            }
+
+    def is_finished(self) -> bool:
+        """True once the listing is sealed and every shard is done."""
+        progress = self.progress()
+        return progress['sealed'] and set(progress['shards']) <= {'done'}
+
+    def rows(self) -> Iterator[List[str]]:
+        """Output rows in listing order; questions given up without a row get one with empty fields."""
+        with self._lock:
+            tasks = self._conn.execute("SELECT question, topic, url, row FROM tasks ORDER BY seq").fetchall()
+        for question, topic, url, row in tasks:
+            yield json.loads(row) if row else build_output_row({'Question ID': question, 'Topic': topic, 'URL': url})
+
+    def close(self):
+        self._conn.close()
+
+
+def run_worker(work_queue: WorkQueue, worker: str, concurrency: int = DEFAULT_CONCURRENCY,
+               max_retries: int = DEFAULT_MAX_RETRIES, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+               max_attempts: int = DEFAULT_MAX_ATTEMPTS, cache: Optional[ResponseCache] = None,
+               stats: Optional[RunStats] = None) -> int:
+    """
+    Claims shards of `work_queue` as `worker` and fetches their questions
+    with up to `concurrency` threads, paced by one AdaptiveLimiter across
+    shards, until every shard of the sealed queue is done. The lease of the
+    current shard is renewed in the background; an interrupted worker gives
+    its shard back. Returns the number of shards this worker completed.
+    """
+    stats = stats if stats is not None else RunStats()
+    limiter = AdaptiveLimiter(max_concurrency=concurrency)
+    # Keep-alive sessions, each used by one fetch thread at a time, across shards
+    session_pool = SessionPool()
+    completed = 0
+
+    def fetch(task: Tuple[int, QuestionRecord]) -> Tuple[int, List[str], bool]:
+        seq, record = task
+        session = session_pool.acquire()
+        try:
+            with stats.timer('detail/fetch_and_extract'):
+                row, errors = fetch_and_extract(session, seq, record, cache=cache, limiter=limiter,
+                                                max_retries=max_retries, stats=stats)
+        finally:
+            session_pool.release(session)
+        return seq, row, errors > 0
+
+    def keep_leased(shard: Shard, done: threading.Event, lost: threading.Event):
+        while not done.wait(lease_seconds / 3):
+            if not work_queue.renew(shard.id, worker, lease_seconds):
+                lost.set()
+                return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetch')
+    try:
+        while True:
+            shard = work_queue.claim(worker, lease_seconds, max_attempts)
+            if shard is None:
+                if work_queue.is_finished():
+                    break
+                time.sleep(POLL_INTERVAL) # Wait for the coordinator, or for a lease to expire
+                continue
+
+            print(f"Shard {shard.id}: {len(shard.tasks)} questions (attempt {shard.attempts}).")
+            done, lost = threading.Event(), threading.Event()
+            renewer = threading.Thread(target=keep_leased, args=(shard, done, lost), name="lease", daemon=True)
+            renewer.start()
+            try:
+                with stats.timer('queue/shard'):
+                    results = list(executor.map(fetch, shard.tasks))
+            except BaseException:
+                work_queue.release(shard.id, worker)
+                raise
+            finally:
+                done.set()
+                renewer.join()
+
+            if not lost.is_set() and work_queue.complete(shard.id, worker, results, max_attempts):
+                completed += 1
+                stats.inc('queue/shards_completed')
+                stats.inc('queue/questions_failed', sum(failed for _, _, failed in results))
+            else:
+                print(f"Lease of shard {shard.id} lost to another worker, results dropped.")
+                stats.inc('queue/shards_lost')
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        session_pool.close()
+        stats.inc('detail/throttled_responses', limiter.throttled)
+    return completed
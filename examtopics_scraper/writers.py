@@ -0,0 +1,208 @@
+import csv
+import json
+import os
+from enum import Enum
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+# Rows buffered before a CSV or JSON Lines writer hands them to the file
+WRITE_BATCH_SIZE = 500
+
+# Rows per Parquet row group: large enough to compress well, small enough to
+# keep memory flat on multi-exam dumps
+PARQUET_ROW_GROUP_SIZE = 10_000
+PARQUET_COMPRESSION = 'zstd'
+
+
+class OutputFormat(str, Enum):
+    """Output file formats of the question details."""
+    csv = "csv"
+    jsonl = "jsonl"
+    parquet = "parquet"
+
+
+# Formats inferred from the output file extension; anything else is CSV
+FORMAT_EXTENSIONS = {
+    '.csv': OutputFormat.csv,
+    '.jsonl': OutputFormat.jsonl,
+    '.ndjson': OutputFormat.jsonl,
+    '.parquet': OutputFormat.parquet,
+}
+
+
+def write_atomically(path: str, content: str):
+    """Writes `content` to `path` through a temporary file renamed over it, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out_file:
+        out_file.write(content)
+    os.replace(tmp_path, path)
+
+
+def output_format_for(path: str, output_format: Optional[str] = None) -> OutputFormat:
+    """The explicit `output_format` if given, otherwise the format of `path`'s extension (CSV by default)."""
+    if output_format:
+        return OutputFormat(output_format)
+    return FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), OutputFormat.csv)
+
+
+class RowWriter:
+    """
+    Streams rows ordered as `header` to a file, `batch_size` rows at a time.
+
+    Subclasses implement `_open`, `_write_batch` and `_close`. With `append`,
+    rows are added to an existing, non-empty file when the format allows it.
+    """
+
+    supports_append = True
+
+    def __init__(self, path: str, header: Sequence[str], append: bool = False,
+                 batch_size: int = WRITE_BATCH_SIZE):
+        self.path = path
+        self.header = list(header)
+        self.append = append and os.path.exists(path) and os.path.getsize(path) > 0
+        if self.append and not self.supports_append:
+            raise ValueError(f"{type(self).__name__} cannot append to the existing file {path}")
+        self.batch_size = batch_size
+        self.row_count = 0
+        self._batch: List[List[str]] = []
+        self._open()
+
+    def write_row(self, row: Sequence[str]):
+        self._batch.append(list(row))
+        self.row_count += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows: Iterable[Sequence[str]]):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        if self._batch:
+            self._write_batch(self._batch)
+            self._batch = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _write_batch(self, rows: List[List[str]]):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class CsvRowWriter(RowWriter):
+    """CSV with a header line (not repeated when appending)."""
+
+    def _open(self):
+        self._file = open(self.path, 'a' if self.append else 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        if not self.append:
+            self._writer.writerow(self.header) # Write header
+
+    def _write_batch(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class JsonLinesRowWriter(RowWriter):
+    """One JSON object per line, keyed by the header."""
+
+    def _open(self):
+        self._file = open(self.path, 'a' if self.append else 'w', encoding='utf-8')
+
+    def _write_batch(self, rows):
+        self._file.writelines(json.dumps(dict(zip(self.header, row)), ensure_ascii=False) + "\n" for row in rows)
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetRowWriter(RowWriter):
+    """
+    Compressed Parquet file with one string column per header field, written
+    one row group per batch. Requires the optional pyarrow dependency
+    (pip install examtopics_scraper[parquet]). Parquet files cannot be
+    appended to.
+    """
+
+    supports_append = False
+
+    def __init__(self, path: str, header: Sequence[str], append: bool = False,
+                 batch_size: int = PARQUET_ROW_GROUP_SIZE):
+        super().__init__(path, header, append, batch_size)
+
+    def _open(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow: pip install examtopics_scraper[parquet]") from e
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(name, pyarrow.string()) for name in self.header])
+        self._writer = pyarrow.parquet.ParquetWriter(self.path, self._schema, compression=PARQUET_COMPRESSION)
+
+    def _write_batch(self, rows):
+        columns = [self._pa.array(column, type=self._pa.string()) for column in zip(*rows)]
+        self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+
+    def _close(self):
+        self._writer.close()
+
+
+WRITERS = {
+    OutputFormat.csv: CsvRowWriter,
+    OutputFormat.jsonl: JsonLinesRowWriter,
+    OutputFormat.parquet: ParquetRowWriter,
+}
+
+
+def open_writer(path: str, header: Sequence[str], append: bool = False,
+                output_format: Optional[str] = None) -> RowWriter:
+    """Opens the RowWriter of `output_format`, or of the format of `path`'s extension."""
+    return WRITERS[output_format_for(path, output_format)](path, header, append=append)
+
+
+def read_rows(path: str, header: Sequence[str], output_format: Optional[str] = None) -> Iterator[List[str]]:
+    """
+    Reads back the rows of a file written by `open_writer`, ordered as
+    `header` (missing columns are empty strings), in batches for Parquet.
+    """
+    output_format = output_format_for(path, output_format)
+    if output_format == OutputFormat.csv:
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file)
+            columns = next(reader, [])
+            positions = [columns.index(name) if name in columns else None for name in header]
+            for row in reader:
+                yield [row[i] if i is not None and i < len(row) else "" for i in positions]
+    elif output_format == OutputFormat.jsonl:
+        with open(path, encoding='utf-8') as jsonl_file:
+            for line in jsonl_file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield [record.get(name) or "" for name in header]
+    else:
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        columns = [name for name in header if name in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(columns=columns):
+            records = batch.to_pydict()
+            for index in range(batch.num_rows):
+                yield [records[name][index] or "" if name in records else "" for name in header]